@@ -0,0 +1,45 @@
+"""Benchmarks for the protocol and client stack; see suite.py
+
+The workloads live in the bench_*.py scripts, each of which can be
+run on its own, and suite.py runs them all.  Connection is the setup
+they share.
+"""
+
+import socket
+import wayland.client
+
+class Connection:
+    """A Display over a socketpair, with no compositor.
+
+    Nothing is ever read from the server end, so requests pile up in
+    the send queue unless the benchmark empties it.
+    """
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.server, client = socket.socketpair()
+        self.display = wayland.client.MakeDisplay(protocol)(client)
+
+    def bind(self):
+        """Create a registry, a surface and a pointer to work with
+
+        They are available as the "registry", "surface" and "pointer"
+        attributes.  The requests that created them are discarded.
+        """
+        protocol = self.protocol
+        self.registry = self.display.get_registry()
+        compositor = self.registry.bind(1, protocol['wl_compositor'], 3)
+        self.surface = compositor.create_surface()
+        seat = self.registry.bind(2, protocol['wl_seat'], 4)
+        self.pointer = seat.get_pointer()
+        del self.display._send_queue[:]
+        return self
+
+    def close(self):
+        self.display.disconnect()
+        self.server.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,64 @@
+"""Message rate benchmark with message logging off and on
+
+Measures requests marshalled and events decoded and dispatched per
+second, with per-message logging switched off (the default), and
+switched on but filtered out by the logger level, which is the cost
+every message used to pay.
+
+Run from the top of the source tree:
+
+    python3 benchmarks/bench_logging.py
+"""
+
+import os
+import sys
+import io
+import struct
+import time
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wayland.protocol
+from benchmarks import Connection
+from tests.data import sample_protocol
+
+def requests(display, surface, count):
+    start = time.perf_counter()
+    for i in range(count):
+        surface.damage(0, 0, 10, 10)
+        if len(display._send_queue) > 1000:
+            del display._send_queue[:]
+    return time.perf_counter() - start
+
+def events(display, pointer, count):
+    # wl_pointer.motion: time, surface_x, surface_y
+    message = struct.pack("IIIii", pointer.oid, (20 << 16) | 2, 0, 256, 256)
+    chunk = message * 50
+    pointer.dispatcher['motion'] = lambda *args: None
+    start = time.perf_counter()
+    for i in range(count // 50):
+        display._decode(chunk)
+        display.dispatch_pending()
+    return time.perf_counter() - start
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    protocol = wayland.protocol.Protocol(io.StringIO(sample_protocol))
+    c = Connection(protocol).bind()
+    display, surface, pointer = c.display, c.surface, c.pointer
+    try:
+        count = 100000
+        for enabled in (False, True):
+            wayland.protocol.log_messages(enabled)
+            label = "logging " + ("on" if enabled else "off")
+            t = requests(display, surface, count)
+            print("{:12} {:10.0f} requests/s".format(label, count / t))
+            t = events(display, pointer, count)
+            print("{:12} {:10.0f} events/s".format(label, count / t))
+    finally:
+        wayland.protocol.log_messages(False)
+        c.close()
+
+if __name__ == "__main__":
+    main()
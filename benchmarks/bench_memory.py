@@ -0,0 +1,170 @@
+"""Memory footprint benchmark with budgets
+
+Uses tracemalloc to measure the memory retained by a loaded protocol,
+by each of its interfaces, by a live proxy of each interface, by an
+event waiting on a queue, and by each KiB of data held in a Display's
+send queue and partial event buffer.  Every figure has a budget in
+BUDGETS; the test suite calls check(), so a change that makes any of
+them bigger than its budget fails loudly.  If a change legitimately
+needs more memory, raise the budget in the same commit and say why.
+
+The budgets are calibrated for CPython 3.11; other versions and
+implementations lay out objects differently, so the test suite skips
+the check on them (see calibrated()).
+
+Run from the top of the source tree:
+
+    python3 benchmarks/bench_memory.py
+"""
+
+import os
+import sys
+import io
+import platform
+import gc
+import struct
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wayland.protocol
+import wayland.client
+from benchmarks import Connection
+from tests.data import sample_protocol
+
+# Bytes; roughly 1.5 times the figures measured on CPython 3.11
+BUDGETS = {
+    'protocol': 420000,
+    'interface': 37000,
+    'proxy': 220,
+    'queued_event': 320,
+    # Each queued request is a bytes object in a tuple, which costs
+    # several times the size of a typical short request
+    'send_queue_kib': 11500,
+    'partial_event_kib': 1600,
+}
+
+def calibrated():
+    """Return True if this Python is the one the budgets were set on"""
+    return platform.python_implementation() == "CPython" and \
+        sys.version_info[:2] == (3, 11)
+
+def retained(make):
+    """Return the bytes retained by the objects make() returns"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        keep = make()
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del keep
+    return after - before
+
+def measure(count=1000):
+    """Return a dictionary of measurements, keyed as BUDGETS
+
+    "interface" and "proxy" are the largest of the per-interface
+    figures, which are returned separately under "interfaces" and
+    "proxies".
+    """
+    results = {}
+    protocol = wayland.protocol.Protocol(io.StringIO(sample_protocol))
+    results['protocol'] = retained(
+        lambda: wayland.protocol.Protocol(io.StringIO(sample_protocol)))
+    # Each interface is built from already parsed XML, so only the
+    # Interface, its messages and its proxy class are counted
+    root = ET.parse(io.StringIO(sample_protocol)).getroot()
+    interfaces = {}
+    for element in root.iter('interface'):
+        interfaces[element.get('name')] = retained(
+            lambda: wayland.protocol.Interface(protocol, element))
+    results['interfaces'] = interfaces
+    results['interface'] = max(interfaces.values())
+
+    c = Connection(protocol)
+    display = c.display
+    try:
+        queue = display._default_queue
+        proxies = {}
+        for name, interface in sorted(protocol.interfaces.items()):
+            proxy_class = interface.client_proxy_class
+            # Proxies are entered in the object table as they would be
+            # when created by a request
+            def make():
+                l = []
+                for i in range(count):
+                    oid = display._get_new_oid()
+                    p = proxy_class(display, oid, queue, 1)
+                    display.objects[oid] = p
+                    l.append(p)
+                return l
+            proxies[name] = retained(make) // count
+            for oid in list(display.objects.keys()):
+                if oid != display.oid:
+                    del display.objects[oid]
+                    display.oid_allocator.free(oid)
+        results['proxies'] = proxies
+        results['proxy'] = max(proxies.values())
+
+        c.bind()
+        pointer = c.pointer
+        # wl_pointer.motion: time, surface_x, surface_y
+        data = struct.pack("IIIii", pointer.oid, (20 << 16) | 2,
+                           0, 256, 256) * count
+        results['queued_event'] = retained(
+            lambda: display._decode(data)) // count
+        queue.clear()
+
+        surface = c.surface
+        def make():
+            for i in range(count):
+                surface.damage(0, 0, 10, 10)
+        size = retained(make)
+        nbytes = sum(len(b) for b, fds in display._send_queue)
+        results['send_queue_kib'] = size * 1024 // nbytes
+        del display._send_queue[:]
+
+        # A message header announcing the largest size, and then most
+        # of its body
+        size = wayland.client.MAX_MESSAGE_SIZE
+        header = struct.pack("II", pointer.oid, (size << 16) | 2)
+        results['partial_event_kib'] = retained(
+            lambda: display._decode(header + bytes(size - 16))) \
+            * 1024 // (size - 8)
+        display._read_partial_event = b''
+    finally:
+        c.close()
+    return results
+
+def check(results=None):
+    """Return a list of descriptions of the budgets that were exceeded"""
+    if results is None:
+        results = measure()
+    return ["{} uses {} bytes; budget is {}".format(
+        name, results[name], budget)
+            for name, budget in BUDGETS.items() if results[name] > budget]
+
+def main():
+    results = measure()
+    for name, budget in BUDGETS.items():
+        print("{:20} {:10d} bytes  (budget {})".format(
+            name, results[name], budget))
+    for name, size in results['interfaces'].items():
+        print("  interface {:30} {:6d} bytes".format(name, size))
+    for name, size in results['proxies'].items():
+        print("  proxy {:34} {:6d} bytes".format(name, size))
+    if not calibrated():
+        print("Budgets are calibrated for CPython 3.11, not {} {}".format(
+            platform.python_implementation(), platform.python_version()))
+    failures = check(results)
+    for f in failures:
+        print("OVER BUDGET: " + f)
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Object table churn benchmark
+
+Simulates the object traffic of a long-running client: a set of
+long-lived objects, plus a transient object (such as a wl_callback)
+that is created, looked up a few times and deleted on every cycle.
+The workload is run against the plain dict a Display keeps its
+objects in, against ListTable, and then through a real Display, with
+bench_proxies.via_request(), to include the cost of ID allocation.
+
+ListTable is the list-indexed table that was tried in place of the
+dict.  It is kept here, cut down to what the workloads use, so that
+the comparison can be repeated.  It lost on both workloads, so the
+dict was kept; on CPython 3.11 the figures were:
+
+    dict         churn      930000 cycles/s
+    dict         decode   10000000 lookups/s
+    ListTable    churn      290000 cycles/s
+    ListTable    decode    6600000 lookups/s
+    Display      churn      140000 cycles/s
+
+Run from the top of the source tree:
+
+    python3 benchmarks/bench_objects.py
+"""
+
+import os
+import sys
+import io
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wayland.protocol
+import wayland.client
+from benchmarks import Connection, bench_proxies
+from tests.data import sample_protocol
+
+class ListTable:
+    # Object IDs index a list for each of the client and server
+    # ranges directly; lists grow as needed and shrink when their
+    # highest entries are removed
+    def __init__(self):
+        self._client = []
+        self._server = []
+
+    def _list(self, oid):
+        if oid < wayland.client.SERVER_ID_START:
+            return self._client, oid
+        return self._server, oid - wayland.client.SERVER_ID_START
+
+    def get(self, oid, default=None):
+        # Server IDs are always out of range of the client list
+        try:
+            v = self._client[oid]
+        except IndexError:
+            if oid < wayland.client.SERVER_ID_START:
+                return default
+            try:
+                v = self._server[oid - wayland.client.SERVER_ID_START]
+            except IndexError:
+                return default
+        return default if v is None else v
+
+    def __setitem__(self, oid, obj):
+        l, i = self._list(oid)
+        if i >= len(l):
+            l.extend([None] * (i + 1 - len(l)))
+        l[i] = obj
+
+    def __delitem__(self, oid):
+        l, i = self._list(oid)
+        if i >= len(l) or l[i] is None:
+            raise KeyError(oid)
+        l[i] = None
+        while l and l[-1] is None:
+            l.pop()
+
+def table_churn(table, cycles, live=200, lookups=4):
+    for oid in range(1, live + 1):
+        table[oid] = oid
+    server_oid = wayland.client.SERVER_ID_START
+    table[server_oid] = server_oid
+    transient = live + 1
+    get = table.get
+    start = time.perf_counter()
+    for i in range(cycles):
+        table[transient] = i
+        for j in range(lookups):
+            get(transient)
+            get(1 + (i + j) % live)
+        get(server_oid)
+        del table[transient]
+    return time.perf_counter() - start
+
+def decode_lookups(table, lookups, live=200):
+    # The lookup _decode() performs for every incoming message
+    for oid in range(1, live + 1):
+        table[oid] = oid
+    get = table.get
+    start = time.perf_counter()
+    for i in range(lookups):
+        get(1 + i % live)
+    return time.perf_counter() - start
+
+def main():
+    cycles = 200000
+    lookups = 1000000
+    for name, table in (("dict", dict), ("ListTable", ListTable)):
+        t = table_churn(table(), cycles)
+        print("{:12} churn  {:10.0f} cycles/s".format(name, cycles / t))
+        t = decode_lookups(table(), lookups)
+        print("{:12} decode {:10.0f} lookups/s".format(name, lookups / t))
+    protocol = wayland.protocol.Protocol(io.StringIO(sample_protocol))
+    with Connection(protocol) as c:
+        t = bench_proxies.via_request(c.display, cycles // 4)
+    print("{:12} churn  {:10.0f} cycles/s".format("Display", cycles / 4 / t))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Proxy construction benchmark
+
+Measures how many proxies per second can be created: directly from a
+proxy class, and through a request that creates a new object
+(wl_display.sync, as made for every frame callback and roundtrip)
+followed by the server deleting it again.
+
+Run from the top of the source tree:
+
+    python3 benchmarks/bench_proxies.py
+"""
+
+import os
+import sys
+import io
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wayland.protocol
+from benchmarks import Connection
+from tests.data import sample_protocol
+
+def direct(display, proxy_class, count):
+    queue = display._default_queue
+    start = time.perf_counter()
+    for oid in range(count):
+        proxy_class(display, oid, queue, 1)
+    return time.perf_counter() - start
+
+def via_request(display, count):
+    start = time.perf_counter()
+    for i in range(count):
+        callback = display.sync()
+        display._delete_id(display, callback.oid)
+        if len(display._send_queue) > 1000:
+            del display._send_queue[:]
+    return time.perf_counter() - start
+
+def main():
+    protocol = wayland.protocol.Protocol(io.StringIO(sample_protocol))
+    with Connection(protocol) as c:
+        display = c.display
+        count = 200000
+        t = direct(display, protocol['wl_callback'].client_proxy_class,
+                   count)
+        print("{:12} {:10.0f} proxies/s".format("direct", count / t))
+        count = 50000
+        t = via_request(display, count)
+        print("{:12} {:10.0f} proxies/s".format("sync", count / t))
+
+if __name__ == "__main__":
+    main()
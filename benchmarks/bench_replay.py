@@ -0,0 +1,47 @@
+"""Decode and dispatch throughput replaying a captured session
+
+Record a session by attaching a wayland.capture.Recorder to a Display:
+
+    display.capture = wayland.capture.Recorder("session.wlcap")
+
+and then replay it, decoding only and then decoding and dispatching
+to the default handlers, from the top of the source tree:
+
+    python3 benchmarks/bench_replay.py session.wlcap [protocol.xml ...]
+
+The protocol files must define every interface used in the capture;
+by default the test suite's sample protocol is used.
+"""
+
+import os
+import sys
+import io
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wayland.protocol
+import wayland.capture
+from tests.data import sample_protocol
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            protocol = wayland.protocol.Protocol(f)
+        for path in sys.argv[3:]:
+            with open(path) as f:
+                protocol = wayland.protocol.Protocol(f, parent=protocol)
+    else:
+        protocol = wayland.protocol.Protocol(io.StringIO(sample_protocol))
+    with wayland.capture.Replay(sys.argv[1], protocol) as replay:
+        for dispatch in (False, True):
+            label = "dispatch" if dispatch else "decode"
+            best = min((replay.run(dispatch=dispatch) for i in range(5)),
+                       key=lambda r: r['seconds'])
+            print("{:10} {:10.0f} events/s {:10.1f} MB/s".format(
+                label, best['events'] / best['seconds'],
+                best['bytes'] / best['seconds'] / 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Compare two result files written by suite.py
+
+    python3 benchmarks/compare.py before.json after.json [--fail PERCENT]
+
+For every benchmark in both files, prints the mean time per loop in
+each, and the change.  Changes smaller than the noise, taken as the
+sum of the two standard deviations, are shown as not significant.
+With --fail, exits with status 1 if any benchmark became significantly
+slower by more than PERCENT percent.
+
+Metadata that differs between the files, such as the Python version
+or the machine, is printed first, since it makes the comparison
+suspect.
+"""
+
+import sys
+import json
+
+def compare(base, new, fail=None):
+    """Print the comparison; return True if nothing regressed past fail"""
+    for key in sorted(set(base['metadata']) | set(new['metadata'])):
+        if key in ('date', 'commit'):
+            continue
+        a = base['metadata'].get(key)
+        b = new['metadata'].get(key)
+        if a != b:
+            print("metadata {} differs: {} -> {}".format(key, a, b))
+    ok = True
+    print("{:24} {:>12} {:>12} {:>9}".format(
+        "benchmark", "base (us)", "new (us)", "change"))
+    for name, a in base['benchmarks'].items():
+        b = new['benchmarks'].get(name)
+        if b is None:
+            continue
+        change = (b['mean'] - a['mean']) / a['mean'] * 100
+        significant = abs(b['mean'] - a['mean']) > a['stdev'] + b['stdev']
+        note = ""
+        if not significant:
+            note = "  (not significant)"
+        elif fail is not None and change > fail:
+            note = "  REGRESSION"
+            ok = False
+        print("{:24} {:12.3f} {:12.3f} {:+8.1f}%{}".format(
+            name, a['mean'] * 1e6, b['mean'] * 1e6, change, note))
+    for name in new['benchmarks'].keys() - base['benchmarks'].keys():
+        print("{:24} only in new".format(name))
+    return ok
+
+def main():
+    args = sys.argv[1:]
+    fail = None
+    if "--fail" in args:
+        i = args.index("--fail")
+        fail = float(args[i + 1])
+        del args[i : i + 2]
+    if len(args) != 2:
+        sys.exit(__doc__)
+    with open(args[0]) as f:
+        base = json.load(f)
+    with open(args[1]) as f:
+        new = json.load(f)
+    if not compare(base, new, fail):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
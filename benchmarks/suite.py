@@ -0,0 +1,369 @@
+"""Standard benchmark suite for the protocol and client stack
+
+Covers protocol loading, marshalling of each argument type, decoding
+of fixed and variable size events, dispatch, proxy creation, and
+round trips and fd passing over a socketpair to the mock compositor.
+Results are printed and, with -o, written as JSON together with
+metadata describing the machine, for comparison with compare.py.
+
+Run from the top of the source tree:
+
+    python3 benchmarks/suite.py -o before.json
+    (make changes)
+    python3 benchmarks/suite.py -o after.json
+    python3 benchmarks/compare.py before.json after.json
+
+Options:
+
+    -o FILE         write results to FILE as JSON
+    -k TEXT         only run benchmarks whose names contain TEXT
+    --fast          fewer and shorter runs, for a quick check
+    --list          list the benchmarks and exit
+    --protocol XML  also time loading these protocol files as a set;
+                    may be repeated.  Defaults to wayland.xml and any
+                    wayland-protocols files installed under /usr/share,
+                    skipping those that define an interface already
+                    loaded from a stable file
+    --pyperf        run the benchmarks under pyperf, which must be
+                    installed; the remaining arguments are passed to
+                    pyperf, and its own JSON format and tools are used
+
+Each benchmark is a function taking a number of loops and returning
+the seconds the loops took, so the same functions work with pyperf's
+Runner.bench_time_func().  Workloads that one of the bench_*.py
+scripts also measures are imported from it rather than copied.
+"""
+
+import os
+import sys
+import io
+import glob
+import json
+import platform
+import statistics
+import struct
+import subprocess
+import time
+import datetime
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import wayland.protocol
+import wayland.mockserver
+from benchmarks import Connection, bench_logging, bench_proxies
+from tests.data import sample_protocol
+
+BENCHMARKS = []
+
+def benchmark(name):
+    def register(f):
+        BENCHMARKS.append((name, f))
+        return f
+    return register
+
+protocol = wayland.protocol.Protocol(io.StringIO(sample_protocol))
+
+# Extra protocol files for protocol_load_set; see --protocol
+protocol_files = []
+
+def _interface_names(path):
+    return {i.get('name') for i in ET.parse(path).getroot().iter('interface')}
+
+def _system_protocols(prefix="/usr/share"):
+    # Protocols that were stabilised, such as zwp_linux_dmabuf_v1 and
+    # zwp_tablet_*_v2, are still installed as unstable too.  Loading
+    # both would raise DuplicateInterfaceName, so stable files come
+    # first and later files that define an interface already seen are
+    # skipped.
+    core = os.path.join(prefix, "wayland", "wayland.xml")
+    if not os.path.exists(core):
+        return []
+    files = [core]
+    seen = _interface_names(core)
+    for kind in ("stable", "staging", "unstable"):
+        for path in sorted(glob.glob(os.path.join(
+                prefix, "wayland-protocols", kind, "*", "*.xml"))):
+            names = _interface_names(path)
+            if seen.isdisjoint(names):
+                files.append(path)
+                seen |= names
+    return files
+
+def _connection():
+    return Connection(protocol).bind()
+
+@benchmark("protocol_load_sample")
+def protocol_load_sample(loops):
+    start = time.perf_counter()
+    for i in range(loops):
+        wayland.protocol.Protocol(io.StringIO(sample_protocol))
+    return time.perf_counter() - start
+
+@benchmark("protocol_load_set")
+def protocol_load_set(loops):
+    # Files are read into memory first so only parsing is timed
+    sources = []
+    for path in protocol_files:
+        with open(path) as f:
+            sources.append(f.read())
+    start = time.perf_counter()
+    for i in range(loops):
+        p = None
+        for source in sources:
+            p = wayland.protocol.Protocol(io.StringIO(source), parent=p)
+    return time.perf_counter() - start
+
+def _find_arg(type_):
+    # Marshalling is the same for requests and events
+    for interface in protocol.interfaces.values():
+        for message in interface.requests_by_number + \
+                       interface.events_by_number:
+            for arg in message.args:
+                if arg.type == type_:
+                    return arg
+
+def _marshal(type_, value, close_fds=False):
+    def bench(loops):
+        arg = _find_arg(type_)
+        start = time.perf_counter()
+        for i in range(loops):
+            b, r, fds = arg.marshal([value])
+            if close_fds:
+                os.close(fds[0])
+        return time.perf_counter() - start
+    return bench
+
+for _type, _value in (("int", -42), ("uint", 42), ("fixed", 1.5),
+                      ("string", "xdg_toplevel title"),
+                      ("array", bytes(16))):
+    benchmark("marshal_" + _type)(_marshal(_type, _value))
+
+@benchmark("marshal_object")
+def marshal_object(loops):
+    with _connection() as c:
+        return _marshal("object", c.surface)(loops)
+
+@benchmark("marshal_fd")
+def marshal_fd(loops):
+    # Includes the dup() that lets the caller keep its fd
+    r, w = os.pipe()
+    try:
+        return _marshal("fd", r, close_fds=True)(loops)
+    finally:
+        os.close(r)
+        os.close(w)
+
+@benchmark("request_damage")
+def request_damage(loops):
+    with _connection() as c:
+        return bench_logging.requests(c.display, c.surface, loops)
+
+def _decode(chunk, per_chunk):
+    # Decode only; queued events are dropped
+    def bench(loops):
+        with _connection() as c:
+            display = c.display
+            queue = display._default_queue
+            data = chunk(c)
+            start = time.perf_counter()
+            for i in range(max(1, loops // per_chunk)):
+                display._decode(data)
+                queue.clear()
+            return (time.perf_counter() - start) * loops / \
+                (max(1, loops // per_chunk) * per_chunk)
+    return bench
+
+def _motion_chunk(c):
+    # wl_pointer.motion: time, surface_x, surface_y
+    return struct.pack("IIIii", c.pointer.oid, (20 << 16) | 2,
+                       0, 256, 256) * 50
+
+def _global_chunk(c):
+    # wl_registry.global: name, interface, version
+    messages = []
+    for n, name in enumerate(("wl_compositor", "wl_shm",
+                              "zwp_linux_dmabuf_v1", "wl_seat",
+                              "xdg_wm_base")):
+        l = len(name) + 1
+        s = struct.pack("I", l) + name.encode() + bytes(-l % 4 + 1)
+        body = struct.pack("I", n) + s + struct.pack("I", 1)
+        messages.append(struct.pack("II", c.registry.oid,
+                                    (len(body) + 8) << 16) + body)
+    return b''.join(messages) * 10
+
+benchmark("decode_fixed")(_decode(_motion_chunk, 50))
+benchmark("decode_variable")(_decode(_global_chunk, 50))
+
+@benchmark("dispatch_fixed")
+def dispatch_fixed(loops):
+    with _connection() as c:
+        # bench_logging.events() works in chunks of 50 events
+        n = max(1, loops // 50) * 50
+        return bench_logging.events(c.display, c.pointer, n) * loops / n
+
+@benchmark("proxy_create")
+def proxy_create(loops):
+    with _connection() as c:
+        return bench_proxies.direct(
+            c.display, protocol['wl_callback'].client_proxy_class, loops)
+
+@benchmark("proxy_request_delete")
+def proxy_request_delete(loops):
+    # wl_display.sync, as made for every frame callback and roundtrip,
+    # followed by the server deleting the callback
+    with _connection() as c:
+        return bench_proxies.via_request(c.display, loops)
+
+@benchmark("roundtrip")
+def roundtrip(loops):
+    # The mock compositor answers from its own thread
+    with wayland.mockserver.MockCompositor(protocol) as server:
+        display = server.connect()
+        server.start()
+        try:
+            start = time.perf_counter()
+            for i in range(loops):
+                display.roundtrip()
+            return time.perf_counter() - start
+        finally:
+            server.stop()
+            display.disconnect()
+
+@benchmark("fd_passing")
+def fd_passing(loops):
+    # Create and destroy a wl_shm_pool: the fd is duplicated, sent,
+    # received and closed by the server, which then sends delete_id
+    with wayland.mockserver.MockCompositor(protocol) as server:
+        display = server.connect()
+        shm = display.get_registry().bind(2, protocol['wl_shm'], 1)
+        r, w = os.pipe()
+        try:
+            start = time.perf_counter()
+            for i in range(loops):
+                shm.create_pool(r, 4096).destroy()
+                display.flush()
+                server.process()
+                display.recv()
+                display.dispatch_pending()
+            return time.perf_counter() - start
+        finally:
+            os.close(r)
+            os.close(w)
+            display.disconnect()
+
+def metadata():
+    """Describe the machine and the source tree"""
+    m = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python_implementation': platform.python_implementation(),
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'hostname': platform.node(),
+        'cpu_count': os.cpu_count(),
+    }
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    m['cpu_model'] = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    try:
+        m['commit'] = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return m
+
+def measure(f, repeat, min_time):
+    """Time f, returning the number of loops and seconds per loop
+
+    The number of loops is doubled until one run takes at least
+    min_time seconds; then repeat runs are timed.
+    """
+    loops = 1
+    while f(loops) < min_time and loops < 1 << 24:
+        loops *= 2
+    return loops, [f(loops) / loops for i in range(repeat)]
+
+def _selected(pattern):
+    skipped = []
+    for name, f in BENCHMARKS:
+        if pattern and pattern not in name:
+            continue
+        if name == "protocol_load_set" and not protocol_files:
+            skipped.append(name)
+            continue
+        yield name, f
+    for name in skipped:
+        print("{:24} skipped: no protocol files".format(name))
+
+def run_pyperf(argv, pattern):
+    import pyperf
+    # Worker processes are started with program_args, and must
+    # register the same benchmarks as the parent
+    program_args = (sys.argv[0], "--pyperf")
+    if pattern:
+        program_args += ("-k", pattern)
+    runner = pyperf.Runner(program_args=program_args)
+    runner.parse_args(argv)
+    for name, f in _selected(pattern):
+        runner.bench_time_func(name, f)
+
+def main():
+    args = sys.argv[1:]
+    output = None
+    pattern = None
+    repeat, min_time = 10, 0.1
+    if "--pyperf" in args:
+        args.remove("--pyperf")
+        if "-k" in args:
+            i = args.index("-k")
+            pattern = args[i + 1]
+            del args[i : i + 2]
+        protocol_files.extend(_system_protocols())
+        return run_pyperf(args, pattern)
+    while args:
+        a = args.pop(0)
+        if a == "-o":
+            output = args.pop(0)
+        elif a == "-k":
+            pattern = args.pop(0)
+        elif a == "--fast":
+            repeat, min_time = 3, 0.02
+        elif a == "--protocol":
+            protocol_files.append(args.pop(0))
+        elif a == "--list":
+            for name, f in BENCHMARKS:
+                print(name)
+            return
+        else:
+            sys.exit(__doc__)
+    if not protocol_files:
+        protocol_files.extend(_system_protocols())
+    results = {}
+    for name, f in _selected(pattern):
+        loops, values = measure(f, repeat, min_time)
+        results[name] = {
+            'loops': loops,
+            'values': values,
+            'min': min(values),
+            'mean': statistics.mean(values),
+            'stdev': statistics.stdev(values) if len(values) > 1 else 0.0,
+        }
+        print("{:24} {:12.3f} us +- {:.3f}".format(
+            name, results[name]['mean'] * 1e6,
+            results[name]['stdev'] * 1e6))
+    if output:
+        with open(output, "w") as f:
+            json.dump({'metadata': metadata(), 'benchmarks': results},
+                      f, indent=2)
+            f.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -120,6 +120,8 @@ class Window:
         self.redraw_func = redraw
         self.surface = self._w.compositor.create_surface()
         self._w.surfaces[self.surface] = self
+        # Forget the surface once the server has deleted it
+        self.surface.on_deleted = self._w.surfaces.pop
         self.xdg_surface = self._w.xdg_wm_base.get_xdg_surface(self.surface)
         self.xdg_toplevel = self.xdg_surface.get_toplevel()
         self.xdg_toplevel.set_title(title)
@@ -132,7 +134,6 @@ class Window:
             self.xdg_toplevel.set_fullscreen(None)
 
         self.wait_for_configure = True
-        self.xdg_surface.dispatcher['ping'] = ping_handler
         self.xdg_surface.dispatcher['configure'] = \
             self._xdg_surface_configure_handler
 
@@ -446,6 +447,7 @@ class WaylandConnection:
             # We know up to and require version 1
             self.xdg_wm_base = registry.bind(
                 name, self.interfaces['xdg_wm_base'], 1)
+            self.xdg_wm_base.dispatcher['ping'] = ping_handler
         elif interface == "wl_shm":
             # We know up to and require version 1
             self.shm = registry.bind(
@@ -519,6 +521,7 @@ def draw_in_window(w):
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
+    wayland.protocol.log_messages()
 
     # Load the main Wayland protocol.
     wp_base = wayland.protocol.Protocol("/usr/share/wayland/wayland.xml")
@@ -1,10 +1,28 @@
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 
 import wayland.protocol
 import wayland.client
+import wayland.aio
+import wayland.loop
+import wayland.group
+import wayland.trace
+import wayland.capture
+import wayland.mockserver
+import wayland.loadgen
 
 from tests.data import sample_protocol
+from benchmarks import bench_memory
+import argparse
 import io
+import os
+import socket
+import array
+import struct
+import tempfile
+import asyncio
+import threading
+import time
+import weakref
 
 class TestProtocol(TestCase):
     """Test wayland.protocols"""
@@ -42,3 +60,825 @@ class TestProtocol(TestCase):
     def test_interface_version(self):
         for i in self.w.interfaces.keys():
             self.assertIsInstance(self.w[i].version, int)
+
+class TestOidAllocator(TestCase):
+    """Test wayland.client.OidAllocator"""
+
+    def test_lowest_first(self):
+        a = wayland.client.OidAllocator()
+        self.assertEqual([a.allocate() for i in range(6)], [1, 2, 3, 4, 5, 6])
+        for oid in (4, 2, 5):
+            a.free(oid)
+        self.assertEqual([a.allocate() for i in range(4)], [2, 4, 5, 7])
+        stats = a.stats()
+        self.assertEqual(stats['live'], 7)
+        self.assertEqual(stats['reuses'], 3)
+
+    def test_top_shrinks(self):
+        a = wayland.client.OidAllocator()
+        for i in range(4):
+            a.allocate()
+        a.free(2)
+        a.free(3)
+        a.free(4)
+        stats = a.stats()
+        self.assertEqual(stats['top'], 1)
+        self.assertEqual(stats['free'], 0)
+        self.assertEqual(stats['high_water'], 4)
+        self.assertEqual([a.allocate() for i in range(2)], [2, 3])
+
+class TestClient(TestCase):
+    """Test wayland.client against the far end of a socketpair"""
+
+    @classmethod
+    def setUpClass(cls):
+        f = io.StringIO(sample_protocol)
+        cls.w = wayland.protocol.Protocol(f)
+        cls.Display = wayland.client.MakeDisplay(cls.w)
+
+    def setUp(self):
+        self.server, client = socket.socketpair()
+        self.display = self.Display(client)
+
+    def tearDown(self):
+        self.display.disconnect()
+        self.server.close()
+
+    def test_connect_by_name(self):
+        with tempfile.TemporaryDirectory() as d:
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(os.path.join(d, "wayland-test"))
+            listener.listen(1)
+            old = os.environ.get('XDG_RUNTIME_DIR')
+            os.environ['XDG_RUNTIME_DIR'] = d
+            try:
+                display = self.Display("wayland-test")
+                display.disconnect()
+            finally:
+                if old is None:
+                    del os.environ['XDG_RUNTIME_DIR']
+                else:
+                    os.environ['XDG_RUNTIME_DIR'] = old
+                listener.close()
+
+    def _server_recv(self):
+        fds = array.array("i")
+        data, ancdata, flags, addr = self.server.recvmsg(
+            4096, socket.CMSG_SPACE(16 * fds.itemsize))
+        for level, type_, cdata in ancdata:
+            fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+        for fd in fds:
+            os.close(fd)
+        return data, list(fds)
+
+    def _bind_shm(self):
+        registry = self.display.get_registry()
+        return registry.bind(1, self.w['wl_shm'], 1)
+
+    def test_fd_duplicated(self):
+        shm = self._bind_shm()
+        r, w = os.pipe()
+        try:
+            shm.create_pool(r, 4096)
+            self.assertTrue(self.display.flush())
+            data, fds = self._server_recv()
+            self.assertEqual(len(fds), 1)
+            # The caller keeps ownership of the original fd
+            os.fstat(r)
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_fd_transferred(self):
+        shm = self._bind_shm()
+        r, w = os.pipe()
+        try:
+            t = wayland.protocol.TransferFd(r)
+            shm.create_pool(t, 4096)
+            self.assertIsNone(t.fd)
+            self.assertTrue(self.display.flush())
+            data, fds = self._server_recv()
+            self.assertEqual(len(fds), 1)
+            # The library closed the transferred fd after sending it
+            with self.assertRaises(OSError):
+                os.fstat(r)
+        finally:
+            os.close(w)
+
+    def test_user_data(self):
+        callback = self.display.sync()
+        self.assertIsNone(callback.user_data)
+        window = object()
+        callback.user_data = window
+        self.assertIs(callback.user_data, window)
+        with self.assertRaises(AttributeError):
+            callback.window = window
+
+    def test_fd_transferred_objects(self):
+        # An open file would close its fd again when finalized, so it
+        # is refused and left alone
+        with tempfile.TemporaryFile() as f:
+            with self.assertRaises(TypeError):
+                wayland.protocol.TransferFd(f)
+            os.fstat(f.fileno())
+        # A socket gives up its fd
+        shm = self._bind_shm()
+        a, b = socket.socketpair()
+        try:
+            t = wayland.protocol.TransferFd(a)
+            self.assertEqual(a.fileno(), -1)
+            shm.create_pool(t, 4096)
+            self.assertTrue(self.display.flush())
+            data, fds = self._server_recv()
+            self.assertEqual(len(fds), 1)
+        finally:
+            a.close()
+            b.close()
+
+    def test_marshal_failure(self):
+        # A request that fails to marshal sends nothing, closes the fds
+        # it had taken and gives back the ID of its new object
+        shm = self._bind_shm()
+        oid = self.display.sync().oid + 1
+        queued = len(self.display._send_queue)
+        r, w = os.pipe()
+        try:
+            with self.assertRaises(struct.error):
+                shm.create_pool(wayland.protocol.TransferFd(r), "bad")
+            with self.assertRaises(OSError):
+                os.fstat(r)
+            self.assertNotIn(oid, self.display.objects)
+            self.assertEqual(len(self.display._send_queue), queued)
+            self.assertEqual(self.display.sync().oid, oid)
+        finally:
+            os.close(w)
+
+    def _server_send_done(self, data):
+        # Reply to every wl_display.sync request found in data with
+        # wl_callback.done and wl_display.delete_id
+        while data:
+            oid, sizeop = struct.unpack("II", data[:8])
+            size, op = sizeop >> 16, sizeop & 0xffff
+            if oid == 1 and op == 0:
+                (cb, ) = struct.unpack("I", data[8:12])
+                self.server.sendall(
+                    struct.pack("IIi", cb, (12 << 16) | 0, 42) +
+                    struct.pack("IIi", 1, (12 << 16) | 1, cb))
+            data = data[size:]
+
+    def test_async_roundtrip(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            loop.add_reader(self.server.fileno(),
+                            lambda: self._server_send_done(
+                                self._server_recv()[0]))
+            adisplay = wayland.aio.AsyncDisplay(self.display)
+            self.assertIs(adisplay.loop, loop)
+            try:
+                await asyncio.wait_for(adisplay.roundtrip(), 5)
+                data = await asyncio.wait_for(
+                    adisplay.done(self.display.sync()), 5)
+                self.assertEqual(data, 42)
+            finally:
+                adisplay.close()
+                loop.remove_reader(self.server.fileno())
+        asyncio.run(run())
+
+    def test_event_loop(self):
+        loop = wayland.loop.EventLoop()
+        try:
+            loop.add_reader(self.server,
+                            lambda: self._server_send_done(
+                                self._server_recv()[0]))
+            loop.add_display(self.display)
+            done = []
+            def handle_done(callback, data):
+                done.append(data)
+                loop.stop()
+            self.display.sync().dispatcher['done'] = handle_done
+            loop.call_later(5, loop.stop)
+            loop.run()
+            self.assertEqual(done, [42])
+            loop.remove_display(self.display)
+        finally:
+            loop.close()
+
+    def _motion_events(self, count):
+        # Returns the pointer and a list its motion events are logged to
+        seat = self.display.get_registry().bind(1, self.w['wl_seat'], 5)
+        pointer = seat.get_pointer()
+        seen = []
+        pointer.dispatcher['motion'] = lambda p, t, x, y: seen.append(t)
+        data = b''.join(struct.pack("IIIii", pointer.oid, (20 << 16) | 2,
+                                    t, 0, 0) for t in range(count))
+        return pointer, seen, data
+
+    def test_dispatch_budget(self):
+        pointer, seen, data = self._motion_events(10)
+        self.display._decode(data)
+        self.assertTrue(self.display.dispatch_pending(max_events=3))
+        self.assertEqual(seen, [0, 1, 2])
+        # At least one event is always dispatched
+        self.assertTrue(self.display.dispatch_pending(max_time=0))
+        self.assertEqual(len(seen), 4)
+        self.assertFalse(self.display._default_queue.dispatch_pending(
+            max_events=6, max_time=60))
+        self.assertEqual(seen, list(range(10)))
+        self.assertFalse(self.display.dispatch_pending(max_events=1))
+
+    def test_event_loop_budget(self):
+        pointer, seen, data = self._motion_events(5)
+        loop = wayland.loop.EventLoop()
+        try:
+            loop.add_display(self.display, max_events=2)
+            self.server.sendall(data)
+            loop.run_once(5)
+            self.assertEqual(seen, [0, 1])
+            loop.run_once(5)
+            self.assertEqual(seen, [0, 1, 2, 3])
+            loop.run_once(5)
+            self.assertEqual(seen, [0, 1, 2, 3, 4])
+            loop.remove_display(self.display)
+        finally:
+            loop.close()
+
+    def test_event_loop_timers(self):
+        loop = wayland.loop.EventLoop()
+        try:
+            called = []
+            loop.call_later(0, called.append, 1)
+            loop.call_later(0, called.append, 2).cancel()
+            loop.call_later(0.01, loop.stop)
+            loop.run()
+            self.assertEqual(called, [1])
+        finally:
+            loop.close()
+
+    def test_read_coordination(self):
+        done = []
+        self.display.sync().dispatcher['done'] = \
+            lambda callback, data: done.append(data)
+        self.display.flush()
+        self._server_send_done(self._server_recv()[0])
+        # Two readers prepare; the first to call read_events() waits
+        # for the second, which does the reading
+        self.assertTrue(self.display.prepare_read())
+        self.assertTrue(self.display.prepare_read())
+        t = threading.Thread(target=self.display.read_events)
+        t.start()
+        t.join(0.05)
+        self.assertTrue(t.is_alive())
+        self.display.read_events()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertFalse(self.display.prepare_read())
+        self.display.dispatch_pending()
+        self.assertEqual(done, [42])
+
+    def test_cancel_read(self):
+        self.assertTrue(self.display.prepare_read())
+        self.assertTrue(self.display.prepare_read())
+        t = threading.Thread(target=self.display.read_events)
+        t.start()
+        self.display.cancel_read()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+
+    def test_event_queues(self):
+        queue = self.display.create_queue()
+        done = []
+        # One sync on the default queue, one on the new queue
+        self.display.sync().dispatcher['done'] = \
+            lambda callback, data: done.append("default")
+        cb = self.display.sync()
+        cb.set_queue(queue)
+        cb.dispatcher['done'] = lambda callback, data: done.append("queue")
+        self.display.flush()
+        self._server_send_done(self._server_recv()[0])
+        self.assertTrue(queue.dispatch(timeout=5))
+        self.assertEqual(done, ["queue"])
+        # Dispatching any queue handles the display's delete_id events,
+        # leaving only done for the first callback
+        self.assertEqual(len(self.display._default_queue), 1)
+        self.assertEqual(len(self.display._display_queue), 0)
+        self.assertIsNone(cb.oid)
+        self.assertTrue(self.display.dispatch(timeout=5))
+        self.assertEqual(done, ["queue", "default"])
+        # Nothing more is coming
+        self.assertFalse(queue.dispatch(timeout=0))
+
+    def test_timeouts(self):
+        # The server never answers
+        self.assertFalse(self.display.dispatch(timeout=0.01))
+        self.assertFalse(self.display.roundtrip(timeout=0.01))
+        self.assertFalse(self.display.dispatch_until(lambda: False,
+                                                     timeout=0.01))
+        self.assertTrue(self.display.dispatch_until(lambda: True,
+                                                    timeout=0))
+        # Once it does, the reply is dispatched
+        self._server_send_done(self._server_recv()[0])
+        self.assertTrue(self.display.dispatch(timeout=5))
+
+    def test_zombie_closes_fds(self):
+        registry = self.display.get_registry()
+        seat = registry.bind(1, self.w['wl_seat'], 5)
+        keyboard = seat.get_keyboard()
+        keyboard.release()
+        self.assertTrue(keyboard.destroyed)
+        self.display.flush()
+        self._server_recv()
+        r, w = os.pipe()
+        try:
+            # wl_keyboard.keymap carries an fd; it must be closed
+            # rather than handed to the destroyed proxy
+            self.server.sendmsg(
+                [struct.pack("IIII", keyboard.oid, (16 << 16) | 0, 1, 4096),
+                 struct.pack("IIi", 1, (12 << 16) | 1, keyboard.oid)],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                  array.array("i", [r]))])
+            os.close(r)
+            r = None
+            self.assertTrue(self.display.dispatch(timeout=5))
+            self.assertEqual(self.display._incoming_fds, [])
+            self.assertNotIn(keyboard.oid, self.display.objects)
+            with self.assertRaises(BrokenPipeError):
+                os.write(w, b'x')
+        finally:
+            if r is not None:
+                os.close(r)
+            os.close(w)
+
+    def test_unknown_object(self):
+        # An event for an object that never existed is skipped, and
+        # the events after it are still decoded
+        self.server.sendall(struct.pack("IIi", 1000, (12 << 16) | 0, 0) +
+                            struct.pack("IIi", 1, (12 << 16) | 1, 1000))
+        with self.assertLogs("wayland", "WARNING"):
+            self.assertTrue(self.display.dispatch(timeout=5))
+
+    def test_malformed_messages(self):
+        registry = self.display.get_registry()
+        bad = [
+            struct.pack("II", 1, (4 << 16) | 1),
+            struct.pack("IIi", 1, (14 << 16) | 1, 0) + b"xx",
+            struct.pack("II", 1, (8192 << 16) | 1),
+            struct.pack("IIi", 1, (12 << 16) | 9, 0),
+            # wl_registry.global with a string longer than the message
+            struct.pack("IIII", registry.oid, (20 << 16) | 0, 1, 100) +
+            struct.pack("I", 1),
+            # ...with invalid UTF-8, and without its terminating NUL
+            struct.pack("IIII", registry.oid, (24 << 16) | 0, 1, 2) +
+            b"\xff\x00\x00\x00" + struct.pack("I", 1),
+            struct.pack("IIII", registry.oid, (24 << 16) | 0, 1, 4) +
+            b"wl_s" + struct.pack("I", 1),
+        ]
+        for data in bad:
+            self.display._read_partial_event = b''
+            with self.assertRaises(wayland.client.ProtocolError):
+                self.display._decode(data)
+        self.assertEqual(len(self.display._default_queue), 0)
+
+    def test_server_new_id(self):
+        registry = self.display.get_registry()
+        seat = registry.bind(1, self.w['wl_seat'], 4)
+        manager = registry.bind(2, self.w['wl_data_device_manager'], 2)
+        device = manager.get_data_device(seat)
+        start = wayland.client.SERVER_ID_START
+        def offer(oid):
+            # wl_data_device.data_offer
+            self.display._decode(
+                struct.pack("III", device.oid, (12 << 16) | 0, oid))
+        for oid in (20000000, start + 1):
+            with self.assertRaises(wayland.client.ProtocolError):
+                offer(oid)
+        offer(start)
+        offer(start + 1)
+        offer(start)
+        self.assertEqual(
+            self.display.objects[start + 1].interface.name, 'wl_data_offer')
+        self.assertEqual(max(self.display.objects), start + 1)
+
+    def test_lifecycle(self):
+        registry = self.display.get_registry()
+        seat = registry.bind(1, self.w['wl_seat'], 5)
+        keyboard = seat.get_keyboard()
+        pointer = seat.get_pointer()
+        deleted = []
+        keyboard.on_deleted = deleted.append
+        keyboard.release()
+        pointer.release()
+        self.assertEqual(self.display.leak_report(), {
+            'wl_registry': {'live': 1, 'destroyed': 0},
+            'wl_seat': {'live': 1, 'destroyed': 0},
+            'wl_keyboard': {'live': 0, 'destroyed': 1},
+            'wl_pointer': {'live': 0, 'destroyed': 1},
+        })
+        oid = keyboard.oid
+        self.server.sendall(struct.pack("IIi", 1, (12 << 16) | 1, oid))
+        self.assertTrue(self.display.dispatch(timeout=5))
+        self.assertEqual(deleted, [keyboard])
+        self.assertNotIn('wl_keyboard', self.display.leak_report())
+
+    def test_weak_handler(self):
+        class Listener:
+            def done(self, callback, data):
+                calls.append(data)
+        calls = []
+        listener = Listener()
+        callback = self.display.sync()
+        callback.dispatcher['done'] = wayland.protocol.weak_handler(
+            listener.done)
+        event = self.w['wl_callback'].events_by_name['done']
+        callback.dispatch_event(event, [1])
+        del listener
+        callback.dispatch_event(event, [2])
+        self.assertEqual(calls, [1])
+
+    def test_display_group(self):
+        self.assertIs(wayland.client.MakeDisplay(self.w), self.Display)
+        group = wayland.group.DisplayGroup(self.w, budget=1)
+        other_server, other_client = socket.socketpair()
+        try:
+            group.add(self.display)
+            other = group.connect(other_client)
+            done = []
+            for d in (self.display, other):
+                d.sync().dispatcher['done'] = \
+                    lambda callback, data: done.append(callback.display)
+            group.run_once(0)
+            # Both connections flushed; answer them
+            self._server_send_done(self._server_recv()[0])
+            data = other_server.recv(4096)
+            (cb, ) = struct.unpack("I", data[8:12])
+            other_server.sendall(struct.pack("IIi", cb, (12 << 16) | 0, 0))
+            group.run_once(5)
+            # With a budget of one event each, each connection got a turn
+            self.assertCountEqual(done, [self.display, other])
+            group.run_once(0)
+            self.assertEqual(group.stats()['events'], 3)
+            group.remove(self.display)
+            self.assertEqual(len(group), 1)
+        finally:
+            group.close()
+            other_server.close()
+
+    def test_listeners(self):
+        class Listener:
+            def __init__(self):
+                self.seen = []
+            def on_done(self, callback, data):
+                self.seen.append(data)
+        event = self.w['wl_callback'].events_by_name['done']
+        listener = Listener()
+        callback = self.display.sync()
+        callback.add_listener(listener)
+        self.assertEqual(list(callback.dispatcher), ['done'])
+        callback.dispatch_event(event, [1])
+        self.assertEqual(listener.seen, [1])
+        del callback.dispatcher['done']
+        callback.dispatch_event(event, [2])
+        self.assertEqual(listener.seen, [1])
+        with self.assertRaises(KeyError):
+            callback.dispatcher['no_such_event'] = print
+
+    def test_default_listener(self):
+        class Listener:
+            seen = []
+            @classmethod
+            def on_done(cls, callback, data):
+                cls.seen.append(callback)
+        cls = self.w['wl_callback'].client_proxy_class
+        event = self.w['wl_callback'].events_by_name['done']
+        cls.add_default_listener(Listener)
+        try:
+            a = self.display.sync()
+            b = self.display.sync()
+            b.dispatcher['done'] = lambda callback, data: None
+            a.dispatch_event(event, [0])
+            b.dispatch_event(event, [0])
+            self.assertEqual(Listener.seen, [a])
+        finally:
+            cls.set_default_handler('done', None)
+
+    def test_tracer(self):
+        tracer = wayland.trace.Tracer(capacity=2)
+        self.display.tracer = tracer
+        registry = self.display.get_registry()
+        registry.bind(7, self.w['wl_shm'], 1)
+        oid = self.display.sync().oid
+        self.display.flush()
+        self._server_send_done(self._server_recv()[0])
+        self.assertTrue(self.display.dispatch(timeout=5))
+        out = io.StringIO()
+        tracer.dump(out)
+        lines = [l.split("] ", 1)[1] for l in out.getvalue().splitlines()]
+        # Only the last two of the five messages are kept
+        self.assertEqual(tracer.count, 5)
+        self.assertEqual(lines, [
+            "wl_callback@{}.done(42)".format(oid),
+            "wl_display@1.delete_id({})".format(oid),
+        ])
+        tracer = wayland.trace.Tracer()
+        self.display.tracer = tracer
+        registry.bind(7, self.w['wl_shm'], 1)
+        self.assertRegex(
+            next(tracer.lines()),
+            r'^\[ *\d+\.\d{3}\]  -> wl_registry@2\.bind\(7, "wl_shm", 1, '
+            r'new id wl_shm@\d+\)$')
+        # The fd of a TransferFd is recorded before marshalling takes it,
+        # and records don't keep proxies alive
+        shm = registry.bind(7, self.w['wl_shm'], 1)
+        r, w = os.pipe()
+        os.close(w)
+        pool = shm.create_pool(wayland.protocol.TransferFd(r), 4096)
+        self.assertRegex(list(tracer.lines())[-1],
+                         r'create_pool\(new id wl_shm_pool@\d+, '
+                         r'fd {}, 4096\)$'.format(r))
+        ref = weakref.ref(pool)
+        pool.destroy()
+        self.display._delete_id(self.display, pool.oid)
+        del pool
+        self.assertIsNone(ref())
+        # Events are decoded from their wire form when dumped; the
+        # object in wl_display.error has no declared interface
+        pointer = registry.bind(8, self.w['wl_seat'], 4).get_pointer()
+        self.display._decode(
+            struct.pack("IIIii", pointer.oid, (20 << 16) | 2,
+                        5, 384, -128) +
+            struct.pack("IIIII", 1, (24 << 16) | 0, shm.oid, 3, 4) +
+            b"bad\x00")
+        self.assertEqual(
+            [l.split("] ", 1)[1] for l in list(tracer.lines())[-2:]],
+            ["wl_pointer@{}.motion(5, 1.500000, -0.500000)".format(
+                pointer.oid),
+             'wl_display@1.error(wl_shm@{}, 3, "bad")'.format(shm.oid)])
+        self.display._default_queue.clear()
+        self.display._display_queue.clear()
+
+    def test_tracer_threads(self):
+        # Requests from several threads are recorded in wire order
+        tracer = wayland.trace.Tracer(capacity=2000)
+        self.display.tracer = tracer
+        def make_syncs():
+            for i in range(500):
+                self.display.sync()
+        threads = [threading.Thread(target=make_syncs) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(tracer.count, 2000)
+        self.assertEqual(tracer._data,
+                         [b[8:] for b, fds in self.display._send_queue])
+
+    def test_metrics(self):
+        metrics = self.display.enable_metrics()
+        self.assertIs(self.display.enable_metrics(), metrics)
+        self.display.sync()
+        self.display.sync()
+        self.display.flush()
+        data = self._server_recv()[0]
+        self._server_send_done(data[:12])
+        # Send half of the second reply, then the rest
+        self.server.sendall(struct.pack("II", 1000, (12 << 16) | 0))
+        self.assertTrue(self.display.dispatch(timeout=5))
+        self.server.sendall(struct.pack("i", 0))
+        self.assertFalse(self.display.dispatch(timeout=0.01))
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['requests'],
+                         {'wl_display.sync': {'count': 2, 'bytes': 24}})
+        self.assertEqual(snapshot['events'], {
+            'wl_callback.done': {'count': 1, 'bytes': 12},
+            'wl_display.delete_id': {'count': 1, 'bytes': 12}})
+        self.assertEqual(snapshot['sendmsg_calls'], 2)
+        self.assertEqual(snapshot['bytes_sent'], 24)
+        self.assertEqual(snapshot['bytes_received'], 36)
+        self.assertEqual(snapshot['send_queue_high_water'], 2)
+        # done and delete_id go on different queues
+        self.assertEqual(snapshot['event_queue_high_water'], 1)
+        self.assertEqual(snapshot['partial_messages'], 1)
+        self.assertEqual(snapshot['discarded_messages'], 1)
+
+    def test_profiler(self):
+        slow = []
+        profiler = self.display.enable_profiler(
+            threshold=0.005, on_slow=lambda proxy, event, ns: slow.append(
+                (proxy, event.name)))
+        event = self.w['wl_callback'].events_by_name['done']
+        fast = self.display.sync()
+        fast.dispatcher['done'] = lambda callback, data: None
+        sleepy = self.display.sync()
+        sleepy.dispatcher['done'] = lambda callback, data: time.sleep(0.01)
+        fast.dispatch_event(event, [0])
+        sleepy.dispatch_event(event, [0])
+        self.assertEqual(slow, [(sleepy, 'done')])
+        snapshot = profiler.snapshot()['wl_callback.done']
+        self.assertEqual(snapshot['count'], 2)
+        self.assertGreaterEqual(snapshot['max_ns'], 10000000)
+        self.assertLessEqual(snapshot['p50_ns'], snapshot['p99_ns'])
+        self.assertEqual(sum(snapshot['buckets'].values()), 2)
+
+    def test_latency_probe(self):
+        probe = self.display.enable_latency_probe(window=2)
+        self.assertIs(self.display.enable_latency_probe(), probe)
+        self.assertIsNone(probe.oldest_outstanding())
+        probe.probe()
+        self.assertIsNone(probe.maybe_probe(60))
+        self.assertEqual(probe.stats()['outstanding'], 1)
+        self.assertGreaterEqual(probe.oldest_outstanding(), 0)
+        self._server_send_done(self._server_recv()[0])
+        self.assertTrue(self.display.dispatch(timeout=5))
+        for i in range(2):
+            probe.maybe_probe(0)
+            self._server_send_done(self._server_recv()[0])
+            self.assertTrue(self.display.dispatch(timeout=5))
+        stats = probe.stats()
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['outstanding'], 0)
+        self.assertEqual(stats['max'], max(probe.samples))
+        self.assertEqual(stats['last'], probe.samples[-1])
+        self.assertLessEqual(stats['p50'], stats['p99'])
+
+    def test_capture_replay(self):
+        out = io.BytesIO()
+        self.display.capture = wayland.capture.Recorder(out)
+        registry = self.display.get_registry()
+        shm = self._bind_shm()
+        self.display.sync()
+        self.display.flush()
+        data = self._server_recv()[0]
+        self.server.sendall(
+            struct.pack("IIII", registry.oid, (28 << 16) | 0, 1, 7) +
+            b"wl_shm\x00\x00" + struct.pack("I", 1) +
+            struct.pack("III", shm.oid, (12 << 16) | 0, 0) +
+            struct.pack("III", shm.oid, (12 << 16) | 0, 1))
+        self._server_send_done(data)
+        while self.display.dispatch(timeout=0.1):
+            pass
+        self.display.capture.close()
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(out.getvalue())
+            f.flush()
+            with wayland.capture.Replay(f.name, self.w) as replay:
+                kinds = [r[0] for r in replay.records()]
+                self.assertEqual(kinds[0], wayland.capture.SEND)
+                self.assertIn(wayland.capture.RECV, kinds)
+                formats = []
+                cls = self.w['wl_shm'].client_proxy_class
+                cls.set_default_handler(
+                    'format', lambda shm, format: formats.append(format))
+                try:
+                    display = replay.new_display()
+                    stats = replay.run(display)
+                    self.assertEqual(stats['events'], 5)
+                    self.assertEqual(formats, [0, 1])
+                    self.assertIsInstance(display.objects[shm.oid], cls)
+                    self.assertEqual(replay.run(dispatch=False)['events'], 5)
+                    self.assertEqual(formats, [0, 1])
+                finally:
+                    cls.set_default_handler('format', None)
+
+    def test_replay_closes_fds(self):
+        out = io.BytesIO()
+        recorder = wayland.capture.Recorder(out)
+        self.display.capture = recorder
+        registry = self.display.get_registry()
+        seat = registry.bind(1, self.w['wl_seat'], 5)
+        keyboard = seat.get_keyboard()
+        self.display.flush()
+        self._server_recv()
+        # wl_keyboard.keymap carries an fd, and a trailing fd arrives
+        # with no event to claim it
+        recorder.recv(struct.pack("IIII", keyboard.oid, (16 << 16) | 0,
+                                  1, 4096), 1)
+        recorder.recv(b'', 1)
+        recorder.close()
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(out.getvalue())
+            f.flush()
+            with wayland.capture.Replay(f.name, self.w) as replay:
+                before = len(os.listdir("/proc/self/fd"))
+                self.assertEqual(replay.run(dispatch=False)['events'], 1)
+                self.assertEqual(len(os.listdir("/proc/self/fd")), before)
+
+class TestMockCompositor(TestCase):
+    """Test wayland.client against wayland.mockserver"""
+
+    @classmethod
+    def setUpClass(cls):
+        f = io.StringIO(sample_protocol)
+        cls.w = wayland.protocol.Protocol(f)
+
+    def setUp(self):
+        self.server = wayland.mockserver.MockCompositor(self.w)
+        self.display = self.server.connect()
+
+    def tearDown(self):
+        self.server.close()
+        self.display.disconnect()
+
+    def _bind(self, registry, globals, name, version):
+        for n, (interface, v) in globals.items():
+            if interface == name:
+                return registry.bind(n, self.w[name], version)
+
+    def test_private_queue_frees_ids(self):
+        # A client that only ever dispatches its own queue still has
+        # the display's delete_id events handled
+        self.server.start()
+        queue = self.display.create_queue()
+        for i in range(100):
+            self.assertTrue(queue.roundtrip(timeout=5))
+        self.assertEqual(list(self.display.objects), [self.display.oid])
+        self.assertEqual(len(self.display._default_queue), 0)
+        self.assertEqual(self.display.sync().oid, 2)
+
+    def test_threaded(self):
+        self.server.start()
+        globals = {}
+        registry = self.display.get_registry()
+        registry.dispatcher['global'] = lambda r, name, interface, version: \
+            globals.__setitem__(name, (interface, version))
+        self.assertTrue(self.display.roundtrip(timeout=5))
+        self.assertEqual(sorted(globals.values()),
+                         [('wl_compositor', 3), ('wl_shm', 1)])
+        formats = []
+        shm = self._bind(registry, globals, 'wl_shm', 1)
+        shm.dispatcher['format'] = lambda shm, format: formats.append(format)
+        compositor = self._bind(registry, globals, 'wl_compositor', 3)
+        surface = compositor.create_surface()
+        r, w = os.pipe()
+        pool = shm.create_pool(wayland.protocol.TransferFd(r), 4096)
+        os.close(w)
+        buffer = pool.create_buffer(0, 32, 32, 128, 0)
+        released = []
+        buffer.dispatcher['release'] = lambda b: released.append(b)
+        frame_done = []
+        surface.frame().dispatcher['done'] = \
+            lambda cb, time: frame_done.append(cb)
+        surface.attach(buffer, 0, 0)
+        surface.commit()
+        self.assertTrue(self.display.roundtrip(timeout=5))
+        self.assertEqual(formats, [0, 1])
+        self.assertEqual(released, [buffer])
+        self.assertEqual(len(frame_done), 1)
+        self.assertEqual(self.server.objects[pool.oid].state['size'], 4096)
+        surface.destroy()
+        pool.destroy()
+        self.assertTrue(self.display.roundtrip(timeout=5))
+        self.assertEqual(self.server.request_counts['wl_surface.destroy'], 1)
+        self.assertNotIn(surface.oid, self.server.objects)
+        self.assertNotIn('wl_surface', self.display.leak_report())
+
+    def test_firehose(self):
+        registry = self.display.get_registry()
+        shm = registry.bind(2, self.w['wl_shm'], 1)
+        count = 0
+        def format(shm, f):
+            nonlocal count
+            count += 1
+        shm.dispatcher['format'] = format
+        self.display.flush()
+        self.server.process()
+        self.server.firehose(self.server.objects[shm.oid], 'format', (7, ),
+                             count=20000)
+        deadline = time.monotonic() + 5
+        while count < 20002 and time.monotonic() < deadline:
+            self.server.process()
+            self.display.recv()
+            self.display.dispatch_pending()
+        self.assertEqual(count, 20002)
+
+    def test_unknown_object(self):
+        errors = []
+        self.display.dispatcher['error'] = \
+            lambda d, obj, code, message: errors.append(message)
+        self.display._queue_request(struct.pack("II", 42, 8 << 16))
+        self.display.flush()
+        self.server.process()
+        self.assertTrue(self.display.dispatch(timeout=5))
+        self.assertEqual(errors, ["invalid object 42"])
+
+class TestMemory(TestCase):
+    """Check memory use against the budgets in benchmarks/bench_memory.py"""
+
+    @skipUnless(bench_memory.calibrated(),
+                "budgets are calibrated for CPython 3.11")
+    def test_budgets(self):
+        self.assertEqual(bench_memory.check(), [])
+
+class TestLoadGenerator(TestCase):
+    def test_scenarios(self):
+        for scenario in sorted(wayland.loadgen.SCENARIOS):
+            options = argparse.Namespace(
+                mock=True, display=None, connections=2, scenario=scenario,
+                rate=0, depth=2, duration=0.2)
+            result = wayland.loadgen.run_worker(sample_protocol, options)
+            summary = wayland.loadgen.combine([result, result])
+            self.assertEqual(summary['errors'], 0, scenario)
+            self.assertEqual(summary['connections'], 4)
+            self.assertGreater(summary['requests'], 0, scenario)
+            if scenario != "surfaces":
+                self.assertGreater(summary['callbacks'], 0, scenario)
+                self.assertLessEqual(summary['latency_p50'],
+                                     summary['latency_max'])
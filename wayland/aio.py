@@ -0,0 +1,166 @@
+"""asyncio integration for Wayland protocol clients"""
+
+import asyncio
+import collections
+
+class AsyncDisplay:
+    """Drive a Display from an asyncio event loop.
+
+    The connection fd is registered with loop.add_reader(), so any
+    number of displays can share a single event loop without threads
+    or calls to select().  Whenever the server sends data it is read
+    and, unless dispatch is False, the default event queue is
+    dispatched.  Requests are not sent until flush() is called;
+    roundtrip() and done() flush automatically.  If the socket buffer
+    fills up, the remaining requests are sent when the loop reports
+    the fd as writable.
+
+    With dispatch=False events are left on the default queue for the
+    application to consume through events(); it is then responsible
+    for calling proxy.dispatch_event(event, args) on each of them,
+    including the wl_callback "done" events that roundtrip() and
+    done() wait for.
+
+    loop defaults to the running event loop, so without it the
+    adapter must be created from a coroutine or callback running in
+    that loop.
+    """
+    def __init__(self, display, loop=None, dispatch=True):
+        self.display = display
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        self.loop = loop
+        self._dispatch = dispatch
+        self._fd = display.get_fd()
+        self._writing = False
+        self._closed = False
+        self._exception = None
+        # Futures for coroutines waiting for more data from the server
+        self._waiters = collections.deque()
+        self.loop.add_reader(self._fd, self._readable)
+
+    def close(self):
+        """Stop watching the connection.
+
+        The display itself is left connected.  Coroutines waiting on
+        this adapter are woken and will raise an exception, except
+        for events() iterators which simply finish.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self.loop.remove_reader(self._fd)
+        if self._writing:
+            self.loop.remove_writer(self._fd)
+            self._writing = False
+        self._wake()
+
+    def flush(self):
+        """Send buffered requests without blocking.
+
+        If not everything could be sent, a writer callback is installed
+        to finish the job once the socket becomes writable again.
+        Returns True if the send queue was emptied.
+        """
+        if self._closed:
+            return
+        try:
+            flushed = self.display.flush()
+        except Exception as e:
+            self._fail(e)
+            return
+        if flushed:
+            if self._writing:
+                self.loop.remove_writer(self._fd)
+                self._writing = False
+        elif not self._writing:
+            self.loop.add_writer(self._fd, self.flush)
+            self._writing = True
+        return flushed
+
+    def _readable(self):
+        try:
+            while self.display.recv():
+                pass
+            if self._dispatch:
+                self.display.dispatch_pending()
+            else:
+                # IDs must still be freed and errors raised
+                self.display._dispatch_display_queue()
+        except Exception as e:
+            self._fail(e)
+            return
+        # Handlers may have made requests
+        self.flush()
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            w = self._waiters.popleft()
+            if not w.done():
+                w.set_result(None)
+
+    def _fail(self, exc):
+        self._exception = exc
+        # Waiters are woken and find the exception in _check()
+        self.close()
+
+    def _check(self):
+        if self._exception:
+            raise self._exception
+        if self._closed:
+            raise RuntimeError("AsyncDisplay has been closed")
+
+    async def wait_readable(self):
+        """Wait until more data has been read from the server."""
+        self._check()
+        w = self.loop.create_future()
+        self._waiters.append(w)
+        await w
+
+    async def done(self, callback):
+        """Wait for the "done" event on a wl_callback proxy.
+
+        Returns the callback data.
+        """
+        self._check()
+        f = self.loop.create_future()
+        def _done(cb, callback_data):
+            if not f.done():
+                f.set_result(callback_data)
+        callback.dispatcher['done'] = _done
+        self.flush()
+        while not f.done():
+            await self.wait_readable()
+        return f.result()
+
+    async def roundtrip(self):
+        """Send a sync request and wait for the reply."""
+        await self.done(self.display.sync())
+
+    def events(self):
+        """Asynchronously iterate over events on the default queue.
+
+        Yields (proxy, event, args) tuples without dispatching them;
+        only useful when the adapter was created with dispatch=False.
+        """
+        return _EventIterator(self)
+
+class _EventIterator:
+    def __init__(self, adapter):
+        self._adapter = adapter
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        adapter = self._adapter
+        queue = adapter.display._default_queue
+        while not queue:
+            if adapter._closed and not adapter._exception:
+                raise StopAsyncIteration
+            await adapter.wait_readable()
+        e = queue.popleft()
+        if isinstance(e, Exception):
+            raise e
+        return e
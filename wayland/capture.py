@@ -0,0 +1,255 @@
+"""Capture Wayland connection traffic to a file and replay it offline
+
+A capture file starts with an eight byte magic string and is followed
+by records, each a 16 byte header and then the record data:
+
+    uint8   kind: RECV for data received, SEND for data sent
+    uint8   padding
+    uint16  number of file descriptors passed with the data
+    uint32  length of the data in bytes
+    int64   microseconds since the capture started
+
+All integers are little-endian.  File descriptors can't be captured;
+only the number that arrived alongside each chunk of data is kept.
+"""
+
+import mmap
+import os
+import socket
+import struct
+import time
+from wayland.client import MakeDisplay
+
+MAGIC = b"PYWLCAP1"
+RECV = 1
+SEND = 2
+
+_header = struct.Struct("<BxHIq")
+
+class Recorder:
+    """Write the traffic of a Display connection to a capture file.
+
+    file is a path or a binary file object.  Attach the recorder by
+    setting the display's "capture" attribute; every chunk of data
+    read from the server and every chunk of requests written to it is
+    then recorded exactly as it passed through the socket.  To get a
+    capture that can be replayed, attach the recorder before making
+    any requests.
+    """
+    def __init__(self, file):
+        if hasattr(file, 'write'):
+            self._file = file
+            self._close = False
+        else:
+            self._file = open(file, 'wb')
+            self._close = True
+        self._file.write(MAGIC)
+        self._start = time.monotonic()
+
+    def _record(self, kind, data, nfds):
+        t = int((time.monotonic() - self._start) * 1000000)
+        self._file.write(_header.pack(kind, nfds, len(data), t))
+        self._file.write(data)
+
+    def recv(self, data, nfds):
+        """Record data received from the server with nfds fds"""
+        self._record(RECV, data, nfds)
+
+    def send(self, data, nfds):
+        """Record data sent to the server with nfds fds"""
+        self._record(SEND, data, nfds)
+
+    def close(self):
+        """Flush the capture, closing the file if we opened it"""
+        if self._close:
+            self._file.close()
+        else:
+            self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class Replay:
+    """Feed a capture file back through a Display's decode and dispatch.
+
+    The file is mapped into memory rather than read.  protocol must
+    define every interface used in the capture.
+
+    Each run() creates a fresh Display whose socket is never used.
+    Objects the client created are recreated from the captured
+    requests, so events are decoded and dispatched to proxies of the
+    right interfaces and versions just as they were during the
+    recorded session.  Each file descriptor that arrived is replaced
+    by a new fd open on /dev/null.  Requests that handlers make are
+    discarded; handlers should not create objects, because their IDs
+    would clash with the ones in the capture.
+    """
+    def __init__(self, file, protocol):
+        self.protocol = protocol
+        self.Display = MakeDisplay(protocol)
+        with open(file, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self._map.close()
+            raise ValueError("{} is not a capture file".format(file))
+
+    def close(self):
+        """Release the mapped file"""
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def records(self):
+        """Iterate over the records as (kind, time, nfds, data) tuples
+
+        time is in seconds since the capture started.
+        """
+        m = self._map
+        pos = len(MAGIC)
+        end = len(m)
+        while pos + _header.size <= end:
+            kind, nfds, length, t = _header.unpack_from(m, pos)
+            pos += _header.size
+            yield kind, t / 1000000, nfds, m[pos : pos + length]
+            pos += length
+
+    def new_display(self):
+        """Create a Display to replay into
+
+        Handlers can be installed on it, or on the proxy classes of
+        the protocol, before passing it to run().  run() closes the
+        far end of its socket when it finishes.
+        """
+        client, server = socket.socketpair()
+        display = self.Display(client)
+        # Keep the other end open so the socket never appears closed
+        display._replay_peer = server
+        return display
+
+    def run(self, display=None, dispatch=True):
+        """Replay the whole capture as fast as possible.
+
+        If display is None, a new one is created with new_display().
+        If dispatch is False, events are decoded and then dropped
+        without being dispatched.
+
+        Returns a dictionary with the number of "events" decoded, the
+        "bytes" of event data fed through the decoder, and the
+        "seconds" the replay took.
+        """
+        created = display is None
+        if created:
+            display = self.new_display()
+        queue = display._default_queue
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        events = 0
+        nbytes = 0
+        # Requests may have been split between two sendmsg() calls
+        sent = b''
+        start = time.perf_counter()
+        try:
+            for kind, t, nfds, data in self.records():
+                if kind == SEND:
+                    sent = _apply_requests(display, sent + data)
+                    continue
+                for i in range(nfds):
+                    display._incoming_fds.append(os.dup(devnull))
+                display._decode(data)
+                nbytes += len(data)
+                events += len(queue) + len(display._display_queue)
+                if dispatch:
+                    display.dispatch_pending()
+                else:
+                    _drop_events(display._display_queue)
+                    _drop_events(queue)
+                for b, fds in display._send_queue:
+                    for fd in fds:
+                        os.close(fd)
+                del display._send_queue[:]
+        finally:
+            os.close(devnull)
+            # fds left over by a truncated capture
+            while display._incoming_fds:
+                os.close(display._incoming_fds.pop())
+            peer = getattr(display, '_replay_peer', None)
+            if peer is not None:
+                peer.close()
+                display._replay_peer = None
+            if created:
+                display.disconnect()
+        return {
+            'events': events,
+            'bytes': nbytes,
+            'seconds': time.perf_counter() - start,
+        }
+
+def _drop_events(queue):
+    # Discard queued events without dispatching them, closing the fds
+    # that arrived with them
+    for proxy, event, args in queue:
+        if event.fd_count:
+            for arg, v in zip(event.args, args):
+                if arg.type == "fd":
+                    os.close(v)
+    queue.clear()
+
+def _apply_requests(display, data):
+    # Recreate the objects created by the requests in data, and
+    # destroy those destroyed by them.  Returns any trailing partial
+    # request.
+    objects = display.objects
+    protocol = display.interface.protocol
+    while len(data) >= 8:
+        oid, sizeop = struct.unpack_from("II", data)
+        size = sizeop >> 16
+        if len(data) < size:
+            break
+        proxy = objects.get(oid)
+        if proxy is not None and not proxy.destroyed:
+            request = proxy.interface.requests_by_number[sizeop & 0xffff]
+            for name, version, nid in _new_objects(request, data):
+                if version is None:
+                    version = proxy.version
+                try:
+                    npc = protocol[name].client_proxy_class
+                except KeyError:
+                    continue
+                objects[nid] = npc(display, nid, display._default_queue,
+                                   version)
+            if request.is_destructor and proxy is not display:
+                proxy.destroyed = True
+                display._zombify(proxy)
+        data = data[size:]
+    return data
+
+def _new_objects(request, data):
+    # Yield (interface name, version, id) for each object created by
+    # a marshalled request; version is None if it is inherited from
+    # the object the request was made on
+    pos = 8
+    for arg in request.args:
+        if arg.type == "fd":
+            continue
+        if arg.type == "new_id" and not arg.interface:
+            (length, ) = struct.unpack_from("I", data, pos)
+            name = bytes(data[pos + 4 : pos + 3 + length]).decode('utf-8')
+            pos += 4 + ((length + 3) & ~3)
+            version, nid = struct.unpack_from("II", data, pos)
+            pos += 8
+            yield name, version, nid
+        elif arg.type == "new_id":
+            (nid, ) = struct.unpack_from("I", data, pos)
+            pos += 4
+            yield arg.interface, None, nid
+        elif arg.type in ("string", "array"):
+            (length, ) = struct.unpack_from("I", data, pos)
+            pos += 4 + ((length + 3) & ~3)
+        else:
+            pos += 4
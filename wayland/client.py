@@ -1,12 +1,27 @@
 """Wayland protocol client implementation"""
 
 import wayland.protocol
+import wayland.trace
+import wayland.metrics
 import os
 import socket
+import sys
 import select
 import struct
 import array
 import io
+import threading
+import collections
+import time
+import math
+import heapq
+import logging
+
+# Object IDs from this value upwards are allocated by the server
+SERVER_ID_START = 0xff000000
+
+# The largest message libwayland will send or accept
+MAX_MESSAGE_SIZE = 4096
 
 class ServerDisconnected(Exception):
     """The server disconnected unexpectedly"""
@@ -17,7 +32,11 @@ class NoXDGRuntimeDir(Exception):
     pass
 
 class ProtocolError(Exception):
-    """The server sent data that could not be decoded"""
+    """The server sent data that could not be decoded
+
+    Nothing more can be read from the connection once this has been
+    raised.
+    """
     pass
 
 class UnknownObjectError(Exception):
@@ -41,28 +60,178 @@ class DisplayError(Exception):
         return "DisplayError({}, {} (\"{}\"), {})".format(
             self.obj, self.code, self.codestr, self.message)
 
+class _Zombie:
+    # Stands in for a proxy the client has destroyed, until the server
+    # acknowledges the destruction with wl_display.delete_id.  Events
+    # that were already in flight are skipped; the interface is kept
+    # so that fds sent with them can be found and closed.  The proxy
+    # itself is only kept if it wants to hear about its deletion.
+    __slots__ = ('interface', 'proxy')
+    destroyed = True
+
+    def __init__(self, interface, proxy=None):
+        self.interface = interface
+        self.proxy = proxy
+
+    def __str__(self):
+        return "zombie {}".format(self.interface.name)
+
+class OidAllocator:
+    """Allocate client object IDs, lowest free ID first.
+
+    Reusing the lowest free ID keeps the range of live IDs compact
+    after heavy churn.
+    Freed IDs are kept in a heap; freeing the highest allocated ID
+    lowers the top of the range instead, past any other free IDs
+    immediately below it.  Those are dropped from the heap lazily.
+    """
+    def __init__(self, first=1, limit=SERVER_ID_START):
+        self._first = first
+        self._limit = limit
+        # Lowest ID that has never been allocated, or has been
+        # returned from the top of the range
+        self._next = first
+        self._free = []
+        self._free_set = set()
+        self.allocations = 0
+        self.reuses = 0
+        self.frees = 0
+        self.high_water = first - 1
+
+    def allocate(self):
+        self.allocations += 1
+        while self._free:
+            oid = heapq.heappop(self._free)
+            if oid in self._free_set:
+                self._free_set.remove(oid)
+                self.reuses += 1
+                return oid
+        oid = self._next
+        if oid >= self._limit:
+            raise RuntimeError("object IDs exhausted")
+        self._next = oid + 1
+        if oid > self.high_water:
+            self.high_water = oid
+        return oid
+
+    def free(self, oid):
+        self.frees += 1
+        if oid == self._next - 1:
+            oid -= 1
+            while oid in self._free_set:
+                self._free_set.remove(oid)
+                oid -= 1
+            self._next = oid + 1
+        else:
+            heapq.heappush(self._free, oid)
+            self._free_set.add(oid)
+
+    def stats(self):
+        """Return a dictionary of allocator statistics.
+
+        live: IDs currently allocated
+        free: freed IDs waiting to be reused
+        top: highest ID currently in the allocated range
+        high_water: highest ID ever allocated
+        allocations, reuses, frees: running totals
+        """
+        return {
+            'live': self._next - self._first - len(self._free_set),
+            'free': len(self._free_set),
+            'top': self._next - 1,
+            'high_water': self.high_water,
+            'allocations': self.allocations,
+            'reuses': self.reuses,
+            'frees': self.frees,
+        }
+
+class EventQueue(collections.deque):
+    """A queue of events waiting to be dispatched.
+
+    Every proxy delivers its events to one queue; by default this is
+    the display's default queue, and proxies created by a request
+    inherit the queue of the proxy the request was made on.  Use
+    Display.create_queue() to make a new queue and
+    ClientProxy.set_queue() to move a proxy onto it.  A queue can then
+    be dispatched independently of the others, for example by a
+    different thread.  The display's own delete_id and error events
+    are handled whichever queue is dispatched.
+
+    Items are (proxy, event, args) tuples.
+    """
+    def __init__(self, display):
+        super(EventQueue, self).__init__()
+        self.display = display
+
+    def dispatch_pending(self, max_events=None, max_time=None):
+        """Dispatch events already on this queue"""
+        return self.display.dispatch_pending(self, max_events, max_time)
+
+    def dispatch(self, timeout=None):
+        """Wait for events on this queue and dispatch them"""
+        return self.display.dispatch(self, timeout)
+
+    def dispatch_until(self, predicate, timeout=None):
+        """Dispatch this queue until predicate() returns True"""
+        return self.display.dispatch_until(predicate, self, timeout)
+
+    def roundtrip(self, timeout=None):
+        """Make a round trip to the server, dispatching this queue"""
+        return self.display.roundtrip(self, timeout)
+
 class _Display:
     """Additional methods for wl_display interface proxy
 
     The wl_display proxy class obtained by loading the Wayland
     protocol XML file needs to be augmented with some additional
     methods to function as a full Wayland protocol client.
+
+    The connection may be shared between threads.  Making requests
+    and flushing are serialised by a lock.  Threads that want to wait
+    for events use prepare_read(), read_events() and cancel_read() to
+    coordinate: whichever thread finishes waiting last reads from the
+    connection and routes the events to the queue of each proxy, so
+    that each thread can dispatch its own queue.
     """
     def __init__(self, name_or_fd=None):
         self._f = None
-        self._oids = iter(range(1, 0xff000000))
-        self._reusable_oids = []
-        self._default_queue = []
+        # A wayland.trace.Tracer, fed every request and event
+        self.tracer = None
+        # A wayland.metrics.Metrics; see enable_metrics()
+        self.metrics = None
+        # A wayland.metrics.HandlerProfiler; see enable_profiler()
+        self.profiler = None
+        # A wayland.metrics.LatencyProbe; see enable_latency_probe()
+        self.latency = None
+        # A wayland.capture.Recorder, fed all data sent and received
+        self.capture = None
+        if os.getenv('WAYLAND_DEBUG') in ('1', 'client'):
+            self.tracer = wayland.trace.Tracer(stream=sys.stderr)
+        # Guards the object table, object ID allocation, the send
+        # queue, incoming data and the reader count
+        self._lock = threading.RLock()
+        self._read_cond = threading.Condition(self._lock)
+        self._readers = 0
+        self._read_serial = 0
+        self.oid_allocator = OidAllocator()
+        self._default_queue = EventQueue(self)
+        # Events for the display itself, delete_id and error, go on a
+        # queue of their own that every dispatch_pending() empties
+        # first, as libwayland's display queue; otherwise a thread
+        # dispatching only its own queue would never see IDs freed or
+        # protocol errors reported
+        self._display_queue = EventQueue(self)
         super(_Display, self).__init__(self, self._get_new_oid(),
                                        self._default_queue, 1)
         if hasattr(name_or_fd, 'fileno'):
             self._f = name_or_fd
-            self.log.info("connected to existing fd %d", self._f)
+            self.log.info("connected to existing fd %d", self._f.fileno())
         else:
             xdg_runtime_dir = os.getenv('XDG_RUNTIME_DIR')
             if not xdg_runtime_dir:
                 raise NoXDGRuntimeDir()
-            if not name_or_fd:
+            display = name_or_fd
+            if not display:
                 display = os.getenv('WAYLAND_DISPLAY')
                 if not display:
                     display = "wayland-0"
@@ -77,8 +246,13 @@ class _Display:
         self._read_partial_event = b''
         self._incoming_fds = []
 
-        self.objects = {self.oid: self}
+        self.objects = {}
+        # One past the highest object ID the server has created
+        self._server_top = SERVER_ID_START
+        self.objects[self.oid] = self
         self._send_queue = []
+        # Reused for the ancillary data of every sendmsg() that passes fds
+        self._send_fds = array.array("i")
 
         self.dispatcher['delete_id'] = self._delete_id
         self.silence['delete_id'] = True
@@ -98,6 +272,43 @@ class _Display:
             self._f.close()
             self._f = None
 
+    def enable_metrics(self):
+        """Start counting traffic on this connection.
+
+        Returns the wayland.metrics.Metrics object, which is also
+        available as the "metrics" attribute.  Calling this again
+        returns the existing object.
+        """
+        if self.metrics is None:
+            self.metrics = wayland.metrics.Metrics()
+        return self.metrics
+
+    def enable_profiler(self, threshold=0.016, on_slow=None):
+        """Start timing the event handlers called for this connection.
+
+        Returns a new wayland.metrics.HandlerProfiler, which is also
+        available as the "profiler" attribute; see there for the
+        arguments.  Set the attribute to None to stop profiling.
+        """
+        self.profiler = wayland.metrics.HandlerProfiler(threshold, on_slow)
+        return self.profiler
+
+    def enable_latency_probe(self, window=256):
+        """Start measuring round trip times to the server.
+
+        Returns the wayland.metrics.LatencyProbe, which is also
+        available as the "latency" attribute.  It keeps the last
+        window samples.  Calling this again returns the existing
+        object.
+        """
+        if self.latency is None:
+            self.latency = wayland.metrics.LatencyProbe(self, window)
+        return self.latency
+
+    def create_queue(self):
+        """Create a new, empty event queue for this connection."""
+        return EventQueue(self)
+
     def get_fd(self):
         """Get the file descriptor number of the server connection.
 
@@ -107,16 +318,80 @@ class _Display:
         return self._f.fileno()
 
     def _get_new_oid(self):
-        if self._reusable_oids:
-            return self._reusable_oids.pop()
-        return next(self._oids)
+        with self._lock:
+            return self.oid_allocator.allocate()
 
     def _delete_id(self, display, id_):
-        self.log.info("server deleted %s", self.objects[id_])
-        self.objects[id_].oid = None
-        del self.objects[id_]
-        if id_ < 0xff000000:
-            self._reusable_oids.append(id_)
+        with self._lock:
+            obj = self.objects.get(id_)
+            if obj is None:
+                self.log.warning("server deleted unknown object %d", id_)
+                return
+            if wayland.protocol._log_messages:
+                self.log.info("server deleted %s", obj)
+            if isinstance(obj, _Zombie):
+                obj = obj.proxy
+            else:
+                obj.oid = None
+            del self.objects[id_]
+            if id_ < SERVER_ID_START:
+                self.oid_allocator.free(id_)
+        if obj is not None and obj.on_deleted:
+            obj.on_deleted(obj)
+
+    def _add_server_object(self, proxy):
+        # Called for a new_id argument in an event.  The server
+        # allocates its IDs upwards from SERVER_ID_START, reusing
+        # freed ones, so like libwayland's wl_map_insert_at() refuse
+        # IDs outside its range or more than one past the highest
+        # seen so far
+        oid = proxy.oid
+        if oid < SERVER_ID_START or oid > self._server_top:
+            raise ProtocolError(
+                "invalid new object ID {} for {}".format(
+                    oid, proxy.interface.name))
+        if oid == self._server_top:
+            self._server_top += 1
+        self.objects[oid] = proxy
+
+    def _zombify(self, proxy):
+        # Called when a destructor request has been queued for proxy,
+        # with the lock still held so that a delete_id read by another
+        # thread finds the zombie.  Returns True if the ID is free
+        # already, in which case the caller calls proxy.on_deleted
+        # once the lock is released.
+        with self._lock:
+            if proxy.oid < SERVER_ID_START:
+                # Events may still arrive until the server sends
+                # delete_id, and the ID can't be reused until then
+                self.objects[proxy.oid] = _Zombie(
+                    proxy.interface, proxy if proxy.on_deleted else None)
+                return False
+            # The server never sends delete_id for objects it created
+            del self.objects[proxy.oid]
+            return True
+
+    def leak_report(self):
+        """Count the objects that are still holding IDs, by interface.
+
+        Returns a dictionary mapping interface names to dictionaries
+        with two counts: "live" for proxies that have not been
+        destroyed, and "destroyed" for objects the client has
+        destroyed but the server has not yet deleted.  The display
+        itself is not included.  In a steady state these counts
+        should stay level; a count that keeps growing points at
+        objects the application is failing to destroy, or that the
+        server is failing to delete.
+        """
+        report = {}
+        with self._lock:
+            for obj in self.objects.values():
+                if obj is self:
+                    continue
+                counts = report.setdefault(
+                    obj.interface.name, {'live': 0, 'destroyed': 0})
+                counts['destroyed' if obj.destroyed else 'live'] += 1
+        return report
 
     def _error_event(self, *args):
         # XXX look up string for error code in enum
@@ -124,8 +399,14 @@ class _Display:
         raise DisplayError(str(objs), str(code), "", str(message))
 
     def _queue_request(self, r, fds=[]):
-        self.log.debug("queueing to send: %s with fds %s", r, fds)
-        self._send_queue.append((r, fds))
+        if wayland.protocol._log_messages:
+            self.log.debug("queueing to send: %s with fds %s", r, fds)
+        with self._lock:
+            self._send_queue.append((r, fds))
+            metrics = self.metrics
+            if metrics is not None and \
+               len(self._send_queue) > metrics.send_queue_high_water:
+                metrics.send_queue_high_water = len(self._send_queue)
 
     def flush(self):
         """Send buffered requests to the display server.
@@ -136,28 +417,57 @@ class _Display:
 
         Returns True if the queue was emptied.
         """
+        with self._lock:
+            return self._flush()
+
+    def _flush(self):
+        sendfds = self._send_fds
+        metrics = self.metrics
         while self._send_queue:
             b, fds = self._send_queue.pop(0)
             try:
-                self._f.sendmsg([b], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
-                                       array.array("i", fds))])
-                for fd in fds:
-                    os.close(fd)
-            except socket.error as e:
-                if socket.errno == 11:
-                    # Would block.  Return the data to the head of the queue
-                    # and try again later!
-                    self.log.debug("flush would block; returning data to queue")
-                    self._send_queue.insert(0, (b, fds))
-                    return
-                raise
+                if fds:
+                    del sendfds[:]
+                    sendfds.extend(fds)
+                    sent = self._f.sendmsg([b], [(socket.SOL_SOCKET,
+                                                  socket.SCM_RIGHTS, sendfds)])
+                    for fd in fds:
+                        os.close(fd)
+                else:
+                    sent = self._f.sendmsg([b])
+            except BlockingIOError:
+                # Would block.  Return the data to the head of the queue
+                # and try again later!
+                self.log.debug("flush would block; returning data to queue")
+                self._send_queue.insert(0, (b, fds))
+                return
+            if metrics is not None:
+                metrics.sendmsg_calls += 1
+                metrics.bytes_sent += sent
+                metrics.fds_sent += len(fds)
+            if self.capture is not None:
+                self.capture.send(b[:sent], len(fds))
+            if sent < len(b):
+                # The socket buffer filled part way through; the fds
+                # went with the first byte, so only the data remains
+                self.log.debug("flush sent %d of %d bytes; returning the "
+                               "rest to queue", sent, len(b))
+                self._send_queue.insert(0, (b[sent:], []))
+                return
         return True
 
     def recv(self):
         """Receive as much data as is available.
 
         Returns True if any data was received.  Will not block.
+
+        When several threads share the connection they should use
+        prepare_read() and read_events() instead.
         """
+        with self._lock:
+            return self._recv()
+
+    def _recv(self):
         data = None
         try:
             fds = array.array("i")
@@ -169,6 +479,13 @@ class _Display:
                     fds.frombytes(cmsg_data[
                         :len(cmsg_data) - (len(cmsg_data) % fds.itemsize)])
             self._incoming_fds.extend(fds)
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.recvmsg_calls += 1
+                metrics.bytes_received += len(data)
+                metrics.fds_received += len(fds)
+            if self.capture is not None and data:
+                self.capture.recv(data, len(fds))
             if data:
                 self._decode(data)
                 return True
@@ -180,84 +497,295 @@ class _Display:
                 return
             raise
 
-    def dispatch(self):
-        """Dispatch the default event queue.
+    def prepare_read(self, queue=None):
+        """Announce the intention to read events from the connection.
+
+        If queue (by default the default event queue), or the queue of
+        events for the display itself, already holds events, returns
+        False; the caller should dispatch them instead of reading.  Otherwise returns True, and the caller must wait
+        for the connection fd to become readable and then call
+        read_events(), or call cancel_read() if it gives up waiting.
+        """
+        with self._lock:
+            if queue is None:
+                queue = self._default_queue
+            if queue or self._display_queue:
+                return False
+            self._readers += 1
+            return True
+
+    def cancel_read(self):
+        """Give up reading after a successful prepare_read()."""
+        with self._lock:
+            self._readers -= 1
+            if self._readers == 0:
+                self._read_serial += 1
+                self._read_cond.notify_all()
+
+    def read_events(self):
+        """Read events after a successful prepare_read().
+
+        If other threads have also prepared to read, blocks until they
+        have all called read_events() or cancel_read(); the last of
+        them reads all available data and routes the events to their
+        queues.  Will not dispatch events.
+        """
+        with self._lock:
+            self._readers -= 1
+            if self._readers > 0:
+                serial = self._read_serial
+                while serial == self._read_serial:
+                    self._read_cond.wait()
+                return
+            try:
+                while self._recv():
+                    pass
+            finally:
+                self._read_serial += 1
+                self._read_cond.notify_all()
+
+    def _wait(self, deadline):
+        # Wait for the connection to become readable, sending any
+        # requests still buffered as the socket accepts them.  Returns
+        # False if the deadline (a time.monotonic() value, or None
+        # for no deadline) passed first.
+        poller = select.poll()
+        while True:
+            with self._lock:
+                flushed = self._flush()
+            poller.register(self._f, select.POLLIN if flushed
+                            else select.POLLIN | select.POLLOUT)
+            if deadline is None:
+                timeout = None
+            else:
+                timeout = max(0, math.ceil(
+                    (deadline - time.monotonic()) * 1000))
+            events = poller.poll(timeout)
+            if not events:
+                return False
+            for fd, mask in events:
+                if mask & ~select.POLLOUT:
+                    return True
+
+    def _dispatch(self, queue, deadline):
+        while self.prepare_read(queue):
+            try:
+                ready = self._wait(deadline)
+            except BaseException:
+                self.cancel_read()
+                raise
+            if not ready:
+                self.cancel_read()
+                return False
+            self.read_events()
+        self.dispatch_pending(queue)
+        return True
+
+    def dispatch(self, queue=None, timeout=None):
+        """Dispatch an event queue.
+
+        If queue is None, dispatches the default event queue.  If the
+        queue is empty, block until events are available on it and
+        dispatch them; events that arrive for other queues are only
+        queued.  If timeout (in seconds) is not None, give up once it
+        has passed.
 
-        If the queue is empty, block until events are available and
-        dispatch them.
+        Returns True if events were dispatched, or False if the
+        timeout expired first.
         """
-        self.flush()
-        while not self._default_queue:
-            select.select([self._f], [], [])
-            self.recv()
-        self.dispatch_pending()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        return self._dispatch(queue, deadline)
 
-    def dispatch_pending(self, queue=None):
+    def dispatch_until(self, predicate, queue=None, timeout=None):
+        """Dispatch an event queue until predicate() returns True.
+
+        predicate is called before waiting and after every batch of
+        events is dispatched.  If timeout (in seconds) is not None,
+        give up once it has passed.
+
+        Returns True if predicate() returned True, or False if the
+        timeout expired first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not predicate():
+            if not self._dispatch(queue, deadline):
+                return False
+        return True
+
+    def dispatch_pending(self, queue=None, max_events=None, max_time=None):
         """Dispatch pending events in an event queue.
 
         If queue is None, dispatches from the default event queue.
-        Will not read from the server connection.
+        Will not read from the server connection.  Events for the
+        display itself, delete_id and error, are always dispatched
+        first, whichever queue is given.
+
+        By default the queue is dispatched until it is empty.  If
+        max_events is not None, at most that many events are
+        dispatched; if max_time is not None, no more events are
+        dispatched once max_time seconds have passed, although at
+        least one always is.  This lets an application interleave
+        rendering, timers and other work with a flood of events.
+
+        Returns True if events remain on the queue.
         """
-        if not queue:
+        if queue is None:
             queue = self._default_queue
-        while queue:
-            e = self._default_queue.pop(0)
+        if self._display_queue:
+            self._dispatch_display_queue()
+        if max_events is None and max_time is None:
+            while True:
+                try:
+                    e = queue.popleft()
+                except IndexError:
+                    return False
+                if isinstance(e, Exception):
+                    raise e
+                proxy, event, args = e
+                proxy.dispatch_event(event, args)
+        deadline = None if max_time is None else time.monotonic() + max_time
+        n = 0
+        while max_events is None or n < max_events:
+            if n and deadline is not None and time.monotonic() >= deadline:
+                break
+            try:
+                e = queue.popleft()
+            except IndexError:
+                return False
             if isinstance(e, Exception):
                 raise e
             proxy, event, args = e
             proxy.dispatch_event(event, args)
+            n += 1
+        return bool(queue)
+
+    def _dispatch_display_queue(self):
+        queue = self._display_queue
+        while True:
+            try:
+                proxy, event, args = queue.popleft()
+            except IndexError:
+                return
+            proxy.dispatch_event(event, args)
 
-    def roundtrip(self):
+    def roundtrip(self, queue=None, timeout=None):
         """Send a sync request to the server and wait for the reply.
 
         Events are read from the server and dispatched if they are on
-        the default event queue.  This call blocks until the "done"
-        event on the wl_callback generated by the sync request has
-        been dispatched.
+        queue, or the default event queue if queue is None.  This call
+        blocks until the "done" event on the wl_callback generated by
+        the sync request has been dispatched, or until timeout seconds
+        have passed if timeout is not None.
+
+        Returns True if the reply arrived, or False if the timeout
+        expired first.
         """
         ready = False
         def set_ready(callback, x):
             nonlocal ready
             ready = True
-        l = self.sync()
-        l.dispatcher['done'] = set_ready
-        while not ready:
-            self.dispatch()
+        # Don't let another thread flush the request before the
+        # handler is in place
+        with self._lock:
+            l = self.sync()
+            if queue is not None:
+                l.set_queue(queue)
+            l.dispatcher['done'] = set_ready
+        return self.dispatch_until(lambda: ready, queue, timeout)
 
     def _decode(self, data):
         # There may be partial event data already received; add to it
         # if it's there
         if self._read_partial_event:
             data = self._read_partial_event + data
-        while len(data) > 8:
+        get = self.objects.get
+        display_queue = self._display_queue
+        tracer = self.tracer
+        metrics = self.metrics
+        while len(data) >= 8:
             oid, sizeop = struct.unpack("II", data[0 : 8])
             
             size = sizeop >> 16
             op = sizeop & 0xffff
 
+            if size < 8 or size & 3 or size > MAX_MESSAGE_SIZE:
+                raise ProtocolError(
+                    "invalid size {} for message to object {}".format(
+                        size, oid))
             if len(data) < size:
-                self.log.debug("partial event received: %d byte event, "
-                               "%d bytes available", size, len(data))
+                if wayland.protocol._log_messages:
+                    self.log.debug("partial event received: %d byte event, "
+                                   "%d bytes available", size, len(data))
                 break
 
-            argdata = io.BytesIO(data[8 : size])
+            body = data[8 : size]
+            argdata = io.BytesIO(body)
             data = data [size : ]
 
-            obj = self.objects.get(oid, None)
-            if obj:
-                with argdata:
+            obj = get(oid)
+            if obj is not None and \
+               op >= len(obj.interface.events_by_number):
+                raise ProtocolError(
+                    "invalid opcode {} for {}@{}".format(
+                        op, obj.interface.name, oid))
+            if obj is None or obj.destroyed:
+                self._discard(oid, obj, op)
+                if metrics is not None:
+                    metrics.discarded_messages += 1
+                continue
+            with argdata:
+                try:
                     e = obj._unmarshal_event(op, argdata, self._incoming_fds)
+                except (wayland.protocol.MalformedMessageException,
+                        struct.error, IndexError, UnicodeDecodeError) as x:
+                    raise ProtocolError(
+                        "malformed {}@{}.{}: {}".format(
+                            obj.interface.name, oid,
+                            obj.interface.events_by_number[op].name,
+                            x)) from x
+                queue = display_queue if obj is self else obj.queue
+                if tracer is not None:
+                    tracer.event(obj, e[1], body, e[2])
+                if metrics is not None:
+                    metrics.event(e[1], size)
+                    if len(queue) >= metrics.event_queue_high_water:
+                        metrics.event_queue_high_water = len(queue) + 1
+                if wayland.protocol._log_messages:
                     self.log.debug(
                         "queueing event: %s(%d) %s %s",
                         e[0].interface.name, e[0].oid, e[1].name, e[2])
-                    obj.queue.append(e)
-            else:
-                obj.queue.append(UnknownObjectError(obj))
+                queue.append(e)
+        if data and metrics is not None:
+            metrics.partial_messages += 1
         self._read_partial_event = data
 
+    def _discard(self, oid, obj, op):
+        # Skip an event for an object we have destroyed or never knew
+        # about, closing any fds that came with it
+        if obj is None:
+            # Expected for server-created objects we have destroyed,
+            # since the server doesn't acknowledge their destruction
+            self.log.log(logging.DEBUG if oid >= SERVER_ID_START
+                         else logging.WARNING,
+                         "event %d for unknown object %d discarded", op, oid)
+            return
+        nfds = obj.interface.events_by_number[op].fd_count
+        if wayland.protocol._log_messages:
+            self.log.debug("event %d for %s(%d) discarded with %d fds",
+                           op, obj, oid, nfds)
+        for i in range(nfds):
+            if self._incoming_fds:
+                os.close(self._incoming_fds.pop(0))
+
+# Display classes already made by MakeDisplay(), keyed by protocol
+_display_classes = {}
+
 def MakeDisplay(protocol):
     """Create a Display class from a Wayland protocol definition
 
+    The class is only created once for each protocol; later calls
+    with the same protocol return the same class.
+
     Args:
         protocol: a wayland.protocol.Protocol instance containing a
         core Wayland protocol definition.
@@ -265,6 +793,10 @@ def MakeDisplay(protocol):
     Returns:
         A Display proxy class built from the specified protocol.
     """
+    try:
+        return _display_classes[protocol]
+    except KeyError:
+        pass
     class Display(_Display, protocol['wl_display'].client_proxy_class):
         pass
-    return Display
+    return _display_classes.setdefault(protocol, Display)
@@ -0,0 +1,184 @@
+"""Service many Wayland connections from one thread"""
+
+import selectors
+import collections
+import time
+from wayland.client import MakeDisplay
+
+class DisplayGroup:
+    """A multiplexer for many Display connections.
+
+    All connections are registered with a single selector (epoll where
+    available).  Each call to run_once() flushes connections with
+    buffered requests, reads from every connection the server has
+    sent data on, and then dispatches the default queue of each
+    connection with pending events in turn, at most budget events per
+    connection, so that one busy connection can't starve the others.
+    Connections with events left over are dispatched first next time
+    round, without waiting for the selector.
+
+    If on_error is None, exceptions raised while servicing a
+    connection propagate out of run_once().  Otherwise the connection
+    is removed from the group and on_error(display, exception) is
+    called.
+    """
+    def __init__(self, protocol, budget=64, on_error=None, selector=None):
+        self.Display = MakeDisplay(protocol)
+        self.budget = budget
+        self.on_error = on_error
+        self._selector = selector or selectors.DefaultSelector()
+        self._displays = []
+        self._writing = set()
+        # Connections with events still to dispatch, in turn order,
+        # and the same connections as a set for membership tests
+        self._backlog = collections.deque()
+        self._backlogged = set()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self._displays)
+
+    def __iter__(self):
+        return iter(list(self._displays))
+
+    def close(self):
+        """Disconnect every connection and release the selector"""
+        for d in list(self._displays):
+            self.remove(d)
+            d.disconnect()
+        self._selector.close()
+
+    def connect(self, name_or_fd=None):
+        """Make a new connection and add it to the group"""
+        d = self.Display(name_or_fd)
+        self.add(d)
+        return d
+
+    def add(self, display):
+        """Add an existing connection to the group"""
+        self._selector.register(display.get_fd(), selectors.EVENT_READ,
+                                display)
+        self._displays.append(display)
+
+    def remove(self, display):
+        """Remove a connection from the group without disconnecting it"""
+        self._selector.unregister(display.get_fd())
+        self._displays.remove(display)
+        self._writing.discard(display)
+        if display in self._backlogged:
+            self._backlogged.discard(display)
+            self._backlog.remove(display)
+
+    def _failed(self, display, exc):
+        self.errors += 1
+        if self.on_error is None:
+            raise exc
+        if display in self._displays:
+            self.remove(display)
+        self.on_error(display, exc)
+
+    def _flush(self, display):
+        if display.flush():
+            if display in self._writing:
+                self._writing.discard(display)
+                self._selector.modify(display.get_fd(),
+                                      selectors.EVENT_READ, display)
+        elif display not in self._writing:
+            self._writing.add(display)
+            self._selector.modify(
+                display.get_fd(),
+                selectors.EVENT_READ | selectors.EVENT_WRITE, display)
+
+    def _dispatch(self, display):
+        # Dispatch up to budget events from the default queue
+        queue = display._default_queue
+        display_queue = display._display_queue
+        before = len(queue) + len(display_queue)
+        try:
+            return display.dispatch_pending(max_events=self.budget)
+        finally:
+            self.events += before - len(queue) - len(display_queue)
+
+    def run_once(self, timeout=None):
+        """Flush, wait for data, read and dispatch one round.
+
+        timeout is the longest time in seconds to wait for data; it is
+        ignored if events are already waiting to be dispatched.
+        """
+        for d in list(self._displays):
+            if d._send_queue:
+                try:
+                    self._flush(d)
+                except Exception as e:
+                    self._failed(d, e)
+        backlog = self._backlog
+        if backlog:
+            timeout = 0
+        for key, mask in self._selector.select(timeout):
+            d = key.data
+            try:
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(d)
+                if mask & selectors.EVENT_READ:
+                    self.reads += 1
+                    while d.recv():
+                        pass
+                    if (d._default_queue or d._display_queue) and \
+                       d not in self._backlogged:
+                        self._backlogged.add(d)
+                        backlog.append(d)
+            except Exception as e:
+                self._failed(d, e)
+        for i in range(len(backlog)):
+            d = backlog.popleft()
+            try:
+                remaining = self._dispatch(d)
+            except Exception as e:
+                self._backlogged.discard(d)
+                self._failed(d, e)
+                continue
+            if remaining:
+                backlog.append(d)
+            else:
+                self._backlogged.discard(d)
+
+    def run(self, duration=None):
+        """Run rounds until no connections are left.
+
+        If duration is not None, stop after that many seconds.
+        """
+        deadline = None if duration is None else time.monotonic() + duration
+        while self._displays:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+            self.run_once(timeout)
+
+    def reset_stats(self):
+        """Zero the counters reported by stats()"""
+        self.reads = 0
+        self.events = 0
+        self.errors = 0
+        self._stats_start = time.monotonic()
+
+    def stats(self):
+        """Return aggregate counters for the whole group.
+
+        connections: number of connections in the group
+        reads: times a readable connection was read from
+        events: events dispatched
+        errors: connections that failed
+        elapsed: seconds since the counters were reset
+        events_per_second: events divided by elapsed
+        """
+        elapsed = time.monotonic() - self._stats_start
+        return {
+            'connections': len(self._displays),
+            'reads': self.reads,
+            'events': self.events,
+            'errors': self.errors,
+            'elapsed': elapsed,
+            'events_per_second': self.events / elapsed if elapsed else 0.0,
+        }
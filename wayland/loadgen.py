@@ -0,0 +1,337 @@
+"""Headless load generator for compositor stress testing
+
+Spawns worker processes, each driving a number of Display connections
+from a wayland.group.DisplayGroup, with every connection running the
+same scenario:
+
+sync: keep depth wl_display.sync requests outstanding, sending another
+as each one completes
+
+frames: attach a shm buffer, damage and commit a surface with a frame
+callback; at rate commits per second if rate is given, otherwise each
+time the previous frame callback completes
+
+surfaces: create a surface, attach a buffer, commit and destroy it,
+rate times per second, or as fast as possible if rate is not given
+
+Each worker reports the requests it sent, the events it received,
+the latency of the callbacks it waited for (wl_callback done events
+for frame callbacks or syncs) and the number of connections that
+failed; the totals are printed when the run ends.
+
+    python3 -m wayland.loadgen --workers 4 --connections 50 \\
+        --scenario frames --rate 60 --duration 10
+
+The protocol is read from /usr/share/wayland/wayland.xml unless
+--protocol is given.  With --mock, every connection is served by a
+wayland.mockserver.MockCompositor thread inside its worker instead of
+a real compositor, which is useful for measuring the client side.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import time
+import wayland.protocol
+import wayland.group
+import wayland.mockserver
+
+SCENARIOS = {}
+
+def scenario(name):
+    def register(cls):
+        SCENARIOS[name] = cls
+        return cls
+    return register
+
+class _Scenario:
+    # Drives one connection.  setup() is called once the globals are
+    # known; tick() at the configured rate, or on every round of the
+    # worker's loop if there is no rate.
+    def __init__(self, display, globals, options, latencies):
+        self.display = display
+        self.globals = globals
+        self.options = options
+        self.latencies = latencies
+
+    def bind(self, name, version):
+        registry, globals = self.globals
+        for n, (interface, v) in globals.items():
+            if interface == name:
+                return registry.bind(
+                    n, self.display.interface.protocol[name],
+                    min(version, v))
+        raise RuntimeError("compositor does not provide " + name)
+
+    def setup(self):
+        pass
+
+    def tick(self, now):
+        pass
+
+    def callback(self, callback, then=None):
+        # Record the latency of callback when it completes
+        if then is None:
+            then = time.monotonic()
+        def done(cb, data):
+            self.latencies.append(time.monotonic() - then)
+            self.done()
+        callback.dispatcher['done'] = done
+
+    def done(self):
+        pass
+
+    def buffer(self, width=64, height=64):
+        """Create a wl_buffer backed by shared memory"""
+        if not hasattr(self, '_pool'):
+            size = width * height * 4
+            if hasattr(os, 'memfd_create'):
+                fd = os.memfd_create("wayland-loadgen")
+            else:
+                fd = os.dup(tempfile.TemporaryFile().fileno())
+            try:
+                os.ftruncate(fd, size)
+                self._pool = self.bind('wl_shm', 1).create_pool(fd, size)
+            finally:
+                os.close(fd)
+        # Format 0 is ARGB8888
+        return self._pool.create_buffer(0, width, height, width * 4, 0)
+
+@scenario("sync")
+class SyncScenario(_Scenario):
+    def setup(self):
+        for i in range(self.options.depth):
+            self.done()
+
+    def done(self):
+        self.callback(self.display.sync())
+
+@scenario("frames")
+class FramesScenario(_Scenario):
+    def setup(self):
+        self.surface = self.bind('wl_compositor', 3).create_surface()
+        self.wl_buffer = self.buffer()
+        if not self.options.rate:
+            self.commit()
+
+    def commit(self):
+        s = self.surface
+        s.attach(self.wl_buffer, 0, 0)
+        s.damage(0, 0, 64, 64)
+        self.callback(s.frame())
+        s.commit()
+
+    def tick(self, now):
+        if self.options.rate:
+            self.commit()
+
+    def done(self):
+        if not self.options.rate:
+            self.commit()
+
+@scenario("surfaces")
+class SurfacesScenario(_Scenario):
+    def setup(self):
+        self.compositor = self.bind('wl_compositor', 3)
+        self.wl_buffer = self.buffer()
+
+    def tick(self, now):
+        s = self.compositor.create_surface()
+        s.attach(self.wl_buffer, 0, 0)
+        s.commit()
+        s.destroy()
+
+def _connect(group, protocol, options, mocks):
+    if options.mock:
+        server = wayland.mockserver.MockCompositor(protocol)
+        server.start()
+        mocks.append(server)
+        display = server.connect()
+    else:
+        display = group.Display(options.display)
+    display.enable_metrics()
+    registry = display.get_registry()
+    globals = {}
+    registry.dispatcher['global'] = lambda r, name, interface, version: \
+        globals.__setitem__(name, (interface, version))
+    registry.dispatcher['global_remove'] = lambda r, name: \
+        globals.pop(name, None)
+    if not display.roundtrip(timeout=10):
+        raise RuntimeError("compositor did not answer")
+    return display, (registry, globals)
+
+def run_worker(protocol_xml, options):
+    """Run one worker's share of the load in this process
+
+    Returns a dictionary of results, as combined by combine().
+    """
+    protocol = wayland.protocol.Protocol(io.StringIO(protocol_xml))
+    failed = []
+    group = wayland.group.DisplayGroup(
+        protocol, on_error=lambda d, e: failed.append(e))
+    latencies = []
+    scenarios = []
+    mocks = []
+    try:
+        for i in range(options.connections):
+            display, globals = _connect(group, protocol, options, mocks)
+            s = SCENARIOS[options.scenario](
+                display, globals, options, latencies)
+            s.setup()
+            scenarios.append(s)
+            group.add(display)
+        # Setup traffic isn't part of the load
+        for s in scenarios:
+            s.display.metrics.reset()
+        del latencies[:]
+        group.reset_stats()
+        start = now = time.monotonic()
+        end = start + options.duration
+        interval = 1.0 / options.rate if options.rate else 0
+        next_tick = start
+        while now < end and len(group):
+            group.run_once(max(0, min(next_tick, end) - now))
+            now = time.monotonic()
+            if now >= next_tick:
+                live = set(group)
+                for s in scenarios:
+                    if s.display in live:
+                        s.tick(now)
+                next_tick = max(next_tick + interval, now) \
+                    if interval else now
+        # Count what was sent, including requests still in the queue
+        elapsed = time.monotonic() - start
+        requests = 0
+        for s in scenarios:
+            for r in s.display.metrics.snapshot()['requests'].values():
+                requests += r['count']
+        stats = group.stats()
+    finally:
+        group.close()
+        for server in mocks:
+            server.close()
+    return {
+        'connections': options.connections,
+        'requests': requests,
+        'events': stats['events'],
+        'errors': len(failed),
+        'error_messages': sorted(set(str(e) for e in failed)),
+        'elapsed': elapsed,
+        'latencies': latencies,
+    }
+
+def combine(results):
+    """Combine the results of several workers into a summary"""
+    latencies = sorted(l for r in results for l in r['latencies'])
+    elapsed = max(r['elapsed'] for r in results)
+    def pct(p):
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, len(latencies) * p // 100)]
+    return {
+        'workers': len(results),
+        'connections': sum(r['connections'] for r in results),
+        'elapsed': elapsed,
+        'requests': sum(r['requests'] for r in results),
+        'requests_per_second': sum(r['requests'] for r in results) / elapsed,
+        'events': sum(r['events'] for r in results),
+        'errors': sum(r['errors'] for r in results),
+        'error_messages': sorted(set(
+            m for r in results for m in r['error_messages'])),
+        'callbacks': len(latencies),
+        'latency_p50': pct(50),
+        'latency_p99': pct(99),
+        'latency_max': latencies[-1] if latencies else None,
+    }
+
+def _worker(protocol_xml, options, results):
+    try:
+        results.put(run_worker(protocol_xml, options))
+    except Exception as e:
+        results.put(e)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python3 -m wayland.loadgen",
+        description="Stress test a Wayland compositor.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument("--connections", type=int, default=10,
+                        help="connections per worker (default: 10)")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS),
+                        default="frames")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="ticks per second for each connection "
+                        "(default: as fast as possible)")
+    parser.add_argument("--depth", type=int, default=1,
+                        help="outstanding syncs per connection for the "
+                        "sync scenario (default: 1)")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to run for (default: 10)")
+    parser.add_argument("--protocol",
+                        default="/usr/share/wayland/wayland.xml",
+                        help="core protocol XML file (default: "
+                        "%(default)s)")
+    parser.add_argument("--display", default=None,
+                        help="compositor socket name (default: "
+                        "$WAYLAND_DISPLAY)")
+    parser.add_argument("--mock", action="store_true",
+                        help="serve each connection from a mock "
+                        "compositor in its worker")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    options = parser.parse_args(argv)
+    with open(options.protocol) as f:
+        protocol_xml = f.read()
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_worker,
+                                       args=(protocol_xml, options, results))
+               for i in range(options.workers)]
+    for w in workers:
+        w.start()
+    collected = []
+    while len(collected) < len(workers):
+        # A worker killed by a signal never reports; once every worker
+        # has exited, anything they sent is already in the queue
+        finished = all(w.exitcode is not None for w in workers)
+        try:
+            collected.append(results.get(timeout=1))
+        except queue.Empty:
+            if finished:
+                sys.exit("{} workers died without reporting "
+                         "(exit status {})".format(
+                             len(workers) - len(collected),
+                             ", ".join(str(w.exitcode) for w in workers
+                                       if w.exitcode)))
+    for w in workers:
+        w.join()
+    for r in collected:
+        if isinstance(r, Exception):
+            sys.exit("worker failed: {}".format(r))
+    summary = combine(collected)
+    if options.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print("{workers} workers, {connections} connections, "
+          "{elapsed:.1f}s".format(**summary))
+    print("requests:  {requests} ({requests_per_second:.0f}/s)".format(
+        **summary))
+    print("events:    {events}".format(**summary))
+    if summary['callbacks']:
+        print("callbacks: {} (latency p50 {:.2f}ms p99 {:.2f}ms "
+              "max {:.2f}ms)".format(
+                  summary['callbacks'], summary['latency_p50'] * 1000,
+                  summary['latency_p99'] * 1000,
+                  summary['latency_max'] * 1000))
+    print("errors:    {errors}".format(**summary))
+    for m in summary['error_messages']:
+        print("  " + m)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Event loop for Wayland protocol clients
+
+A small reactor built on the selectors module.  File descriptors are
+registered once and stay registered, so each wakeup costs time
+proportional to the number of ready fds rather than the number of
+watched fds, and there is no FD_SETSIZE limit where the platform
+provides epoll or kqueue.
+"""
+
+import selectors
+import heapq
+import itertools
+import time
+
+class Timer:
+    """A callback scheduled by EventLoop.call_at() or call_later()"""
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Prevent the callback from being called"""
+        self.cancelled = True
+
+class _DisplayWatch:
+    # Glue between an EventLoop and one Display connection
+    def __init__(self, loop, display, max_events, max_time):
+        self.loop = loop
+        self.display = display
+        self.fd = display.get_fd()
+        self.writing = False
+        self.max_events = max_events
+        self.max_time = max_time
+        # Timer to carry on dispatching a queue left non-empty
+        self.pending = None
+
+    def flush(self):
+        # Called before every poll, and when the connection becomes
+        # writable after a flush was cut short
+        if self.display.flush():
+            if self.writing:
+                self.loop.remove_writer(self.fd)
+                self.writing = False
+        elif not self.writing:
+            self.loop.add_writer(self.fd, self.flush)
+            self.writing = True
+
+    def read(self):
+        while self.display.recv():
+            pass
+        self.dispatch()
+
+    def dispatch(self):
+        if self.display.dispatch_pending(max_events=self.max_events,
+                                         max_time=self.max_time) \
+           and self.pending is None:
+            # Let other callbacks and timers run before the rest
+            self.pending = self.loop.call_later(0, self._resume)
+
+    def _resume(self):
+        self.pending = None
+        self.dispatch()
+
+class EventLoop:
+    """A selectors-based event loop.
+
+    Readers and writers are callables invoked with no arguments when
+    their file object becomes readable or writable.  Prepoll hooks
+    are invoked before every poll; they must not block, and are
+    typically used to flush buffered output.  Timers are scheduled
+    against time.monotonic().
+
+    Display connections added with add_display() are flushed before
+    every poll and have all available data read and their default
+    event queue dispatched whenever the server sends something.
+    """
+    def __init__(self, selector=None):
+        self._selector = selector or selectors.DefaultSelector()
+        self._prepoll = []
+        self._timers = []
+        self._sequence = itertools.count()
+        self._displays = {}
+        self._running = False
+
+    def close(self):
+        """Release the underlying selector"""
+        self._selector.close()
+
+    def _update(self, fileobj, reader, writer):
+        mask = ((selectors.EVENT_READ if reader else 0) |
+                (selectors.EVENT_WRITE if writer else 0))
+        try:
+            key = self._selector.get_key(fileobj)
+        except KeyError:
+            if mask:
+                self._selector.register(fileobj, mask, (reader, writer))
+            return
+        if not mask:
+            self._selector.unregister(fileobj)
+        elif key.events != mask or key.data != (reader, writer):
+            self._selector.modify(fileobj, mask, (reader, writer))
+
+    def _callbacks(self, fileobj):
+        try:
+            return self._selector.get_key(fileobj).data
+        except KeyError:
+            return None, None
+
+    def add_reader(self, fileobj, callback):
+        """Call callback() whenever fileobj is readable"""
+        self._update(fileobj, callback, self._callbacks(fileobj)[1])
+
+    def remove_reader(self, fileobj):
+        """Stop watching fileobj for readability"""
+        self._update(fileobj, None, self._callbacks(fileobj)[1])
+
+    def add_writer(self, fileobj, callback):
+        """Call callback() whenever fileobj is writable"""
+        self._update(fileobj, self._callbacks(fileobj)[0], callback)
+
+    def remove_writer(self, fileobj):
+        """Stop watching fileobj for writability"""
+        self._update(fileobj, self._callbacks(fileobj)[0], None)
+
+    def add_prepoll(self, callback):
+        """Call callback() before every poll"""
+        self._prepoll.append(callback)
+
+    def remove_prepoll(self, callback):
+        """Stop calling callback() before every poll"""
+        self._prepoll.remove(callback)
+
+    def call_at(self, when, callback, *args):
+        """Call callback(*args) at time.monotonic() value when
+
+        Returns a Timer that can be used to cancel the call.
+        """
+        t = Timer(when, callback, args)
+        heapq.heappush(self._timers, (when, next(self._sequence), t))
+        return t
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) after delay seconds"""
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def add_display(self, display, max_events=None, max_time=None):
+        """Service a Display connection from this loop
+
+        If max_events or max_time is not None, each dispatch of the
+        default queue is limited as by Display.dispatch_pending(), and
+        any events left over are dispatched on later iterations, so
+        that a flood of events can't hold up timers and other fds.
+        """
+        w = _DisplayWatch(self, display, max_events, max_time)
+        self._displays[display] = w
+        self.add_reader(w.fd, w.read)
+        self.add_prepoll(w.flush)
+
+    def remove_display(self, display):
+        """Stop servicing a Display connection"""
+        w = self._displays.pop(display)
+        if w.pending is not None:
+            w.pending.cancel()
+        self.remove_prepoll(w.flush)
+        self._update(w.fd, None, None)
+
+    def run_once(self, timeout=None):
+        """Run prepoll hooks, wait for fds or timers, and call callbacks.
+
+        timeout is the longest time in seconds to wait; None means
+        wait until something happens.
+        """
+        for f in list(self._prepoll):
+            f()
+        timers = self._timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+        if timers:
+            delay = max(0, timers[0][0] - time.monotonic())
+            if timeout is None or delay < timeout:
+                timeout = delay
+        if self._selector.get_map():
+            ready = self._selector.select(timeout)
+        else:
+            # selectors may fail when nothing is registered
+            if timeout:
+                time.sleep(timeout)
+            ready = []
+        # Timers scheduled by the callbacks below wait for the next
+        # iteration, so that they can't keep the loop from polling
+        now = time.monotonic()
+        for key, events in ready:
+            reader, writer = key.data
+            if events & selectors.EVENT_WRITE and writer:
+                writer()
+            if events & selectors.EVENT_READ and reader:
+                # The writer may have unregistered the fd
+                reader = self._callbacks(key.fileobj)[0]
+                if reader:
+                    reader()
+        while timers and timers[0][0] <= now:
+            when, seq, t = heapq.heappop(timers)
+            if not t.cancelled:
+                t.callback(*t.args)
+
+    def run(self):
+        """Run until stop() is called"""
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        """Make run() return after the current iteration"""
+        self._running = False
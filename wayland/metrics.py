@@ -0,0 +1,254 @@
+"""Instrumentation for Wayland protocol connections"""
+
+import array
+import collections
+import time
+
+class _InterfaceCounters:
+    # Message and byte counts for one interface, indexed by opcode
+    __slots__ = ('request_counts', 'request_bytes',
+                 'event_counts', 'event_bytes')
+
+    def __init__(self, interface):
+        nreq = len(interface.requests)
+        nev = len(interface.events_by_number)
+        self.request_counts = array.array('Q', bytes(8 * nreq))
+        self.request_bytes = array.array('Q', bytes(8 * nreq))
+        self.event_counts = array.array('Q', bytes(8 * nev))
+        self.event_bytes = array.array('Q', bytes(8 * nev))
+
+class Metrics:
+    """Traffic counters for a Display connection.
+
+    Enable with Display.enable_metrics().  Counters for an interface
+    are allocated as arrays indexed by opcode the first time a message
+    for it is seen; after that, counting a message is a handful of
+    integer increments.
+
+    Besides the per-message counts, these attributes are kept:
+
+    sendmsg_calls, recvmsg_calls: calls made on the socket
+
+    bytes_sent, bytes_received: bytes passed through the socket
+
+    fds_sent, fds_received: file descriptors passed
+
+    partial_messages: reads that ended part way through a message
+
+    discarded_messages: events skipped because their object had been
+    destroyed or was unknown
+
+    send_queue_high_water: most requests waiting to be sent at once
+
+    event_queue_high_water: most events waiting on one queue at once
+    """
+    _scalars = ('sendmsg_calls', 'recvmsg_calls', 'bytes_sent',
+                'bytes_received', 'fds_sent', 'fds_received',
+                'partial_messages', 'discarded_messages',
+                'send_queue_high_water',
+                'event_queue_high_water')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Zero all counters"""
+        self._interfaces = {}
+        for name in self._scalars:
+            setattr(self, name, 0)
+
+    def _counters(self, interface):
+        c = self._interfaces.get(interface)
+        if c is None:
+            c = self._interfaces[interface] = _InterfaceCounters(interface)
+        return c
+
+    def request(self, request, nbytes):
+        """Count a request of nbytes bytes"""
+        c = self._counters(request.interface)
+        c.request_counts[request.opcode] += 1
+        c.request_bytes[request.opcode] += nbytes
+
+    def event(self, event, nbytes):
+        """Count an event of nbytes bytes"""
+        c = self._counters(event.interface)
+        c.event_counts[event.number] += 1
+        c.event_bytes[event.number] += nbytes
+
+    def snapshot(self):
+        """Return the counters as a dictionary of plain values.
+
+        Requests and events are reported under the "requests" and
+        "events" keys as dictionaries keyed by "interface.message"
+        names, each with "count" and "bytes".  Messages that have not
+        been seen are left out.
+        """
+        requests = {}
+        events = {}
+        for interface, c in self._interfaces.items():
+            for r in interface.requests.values():
+                if c.request_counts[r.opcode]:
+                    requests[str(r)] = {
+                        'count': c.request_counts[r.opcode],
+                        'bytes': c.request_bytes[r.opcode],
+                    }
+            for e in interface.events_by_number:
+                if c.event_counts[e.number]:
+                    events["{}.{}".format(interface.name, e.name)] = {
+                        'count': c.event_counts[e.number],
+                        'bytes': c.event_bytes[e.number],
+                    }
+        snapshot = {name: getattr(self, name) for name in self._scalars}
+        snapshot['requests'] = requests
+        snapshot['events'] = events
+        return snapshot
+
+class _Histogram:
+    # Durations in nanoseconds, bucketed by bit length: bucket n
+    # counts durations d with 2**(n-1) <= d < 2**n
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = array.array('Q', bytes(8 * 64))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ns):
+        self.buckets[min(ns.bit_length(), 63)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p'th percentile
+        target = self.count * p / 100.0
+        seen = 0
+        for n, c in enumerate(self.buckets):
+            seen += c
+            if c and seen >= target:
+                return min(1 << n, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total_ns': self.total,
+            'max_ns': self.max,
+            'p50_ns': self.percentile(50),
+            'p99_ns': self.percentile(99),
+            'buckets': {1 << n: c for n, c in enumerate(self.buckets) if c},
+        }
+
+class HandlerProfiler:
+    """Time every event handler invocation on a Display connection.
+
+    Enable with Display.enable_profiler().  Each call to a handler is
+    timed with time.perf_counter_ns() and added to a histogram for
+    its interface and event, with buckets at powers of two
+    nanoseconds.  If a call takes longer than threshold seconds and
+    on_slow is not None, on_slow(proxy, event, elapsed_ns) is called.
+    The default threshold is one frame at 60Hz.
+    """
+    def __init__(self, threshold=0.016, on_slow=None):
+        self.threshold_ns = int(threshold * 1000000000)
+        self.on_slow = on_slow
+        self._histograms = {}
+
+    def reset(self):
+        """Forget all timings"""
+        self._histograms = {}
+
+    def record(self, proxy, event, elapsed_ns):
+        """Add the time taken by one handler call"""
+        h = self._histograms.get(event)
+        if h is None:
+            h = self._histograms[event] = _Histogram()
+        h.add(elapsed_ns)
+        if elapsed_ns > self.threshold_ns and self.on_slow is not None:
+            self.on_slow(proxy, event, elapsed_ns)
+
+    def snapshot(self):
+        """Return the timings as a dictionary.
+
+        Keys are "interface.event" names.  Values are dictionaries
+        with the number of calls, total and maximum time, estimated
+        50th and 99th percentiles, and the non-empty histogram
+        buckets keyed by their upper bound, all in nanoseconds.
+        """
+        return {"{}.{}".format(e.interface.name, e.name): h.snapshot()
+                for e, h in self._histograms.items()}
+
+class LatencyProbe:
+    """Measure round trip times to the compositor.
+
+    Enable with Display.enable_latency_probe().  Each call to probe()
+    sends a wl_display.sync request, flushing without blocking, and
+    the time until the "done" event on the resulting callback is
+    dispatched is added to a rolling window of the last window
+    samples.  Replies are handled on the default event queue, so the
+    times include any delay before the application dispatches it.
+
+    Nothing waits for the reply; call probe() or maybe_probe() from
+    the application's main loop.  A probe that stays unanswered for a
+    long time is a sign of a stalled compositor, and is reported by
+    oldest_outstanding().  All times are in seconds.
+    """
+    def __init__(self, display, window=256):
+        self.display = display
+        self.samples = collections.deque(maxlen=window)
+        # Send times of probes still waiting for their reply
+        self._outstanding = collections.deque()
+        self._last_sent = None
+
+    def probe(self):
+        """Send a sync request now and return its callback proxy"""
+        display = self.display
+        with display._lock:
+            callback = display.sync()
+            callback.dispatcher['done'] = self._done
+            sent = time.perf_counter()
+            self._outstanding.append(sent)
+            self._last_sent = sent
+            display.flush()
+        return callback
+
+    def maybe_probe(self, interval):
+        """Send a probe if none has been sent for interval seconds
+
+        Returns the callback proxy if a probe was sent, otherwise None.
+        """
+        if self._last_sent is None or \
+           time.perf_counter() - self._last_sent >= interval:
+            return self.probe()
+
+    def _done(self, callback, data):
+        # The server answers sync requests in order
+        self.samples.append(time.perf_counter() - self._outstanding.popleft())
+
+    def oldest_outstanding(self):
+        """How long the oldest unanswered probe has waited, or None"""
+        if self._outstanding:
+            return time.perf_counter() - self._outstanding[0]
+
+    def stats(self):
+        """Return the round trip time distribution as a dictionary.
+
+        count is the number of samples in the window; last, p50, p99
+        and max are None if there are none yet.  outstanding is the
+        number of probes waiting for a reply.
+        """
+        samples = sorted(self.samples)
+        n = len(samples)
+        def pct(p):
+            # Nearest rank
+            return samples[max(0, -(-n * p // 100) - 1)] if n else None
+        return {
+            'count': n,
+            'last': self.samples[-1] if n else None,
+            'p50': pct(50),
+            'p99': pct(99),
+            'max': samples[-1] if n else None,
+            'outstanding': len(self._outstanding),
+        }
@@ -0,0 +1,439 @@
+"""A mock Wayland compositor for tests and benchmarks
+
+MockCompositor speaks the Wayland wire protocol over one end of a
+socket.socketpair(), using the same wayland.protocol.Protocol the
+client is built from to decode requests and encode events.  It
+implements just enough of a compositor to exercise a client with no
+display server running:
+
+wl_display: sync is answered immediately; get_registry announces the
+globals
+
+wl_registry: bind creates the object; binding wl_shm announces the
+pixel formats
+
+wl_compositor, wl_shm, wl_shm_pool: objects are created; pool fds are
+closed
+
+wl_surface: frame callbacks are completed, and the attached buffer
+released, on commit
+
+Any destructor request deletes its object and sends delete_id.  Other
+requests are counted and otherwise ignored, unless a handler has been
+installed for them with on() or by defining a handle_<interface>_<request>
+method in a subclass.  Events can be sent explicitly with send_event(),
+or in bulk with firehose().
+
+The server can either run in its own thread, with start() and stop(),
+or be driven from the test's own thread by calling process().
+"""
+
+import collections
+import io
+import os
+import select
+import socket
+import struct
+import threading
+import time
+from wayland.client import MakeDisplay, SERVER_ID_START, MAX_MESSAGE_SIZE
+
+class MockObject:
+    """An object known to the mock compositor"""
+    __slots__ = ('oid', 'interface', 'version', 'state')
+
+    def __init__(self, oid, interface, version):
+        self.oid = oid
+        self.interface = interface
+        self.version = version
+        # Scratch space for request handlers
+        self.state = {}
+
+    def __repr__(self):
+        return "MockObject({}@{})".format(self.interface.name, self.oid)
+
+class MockCompositor:
+    """A scriptable in-process Wayland server.
+
+    protocol is a wayland.protocol.Protocol containing the core
+    protocol.  globals is a list of (interface name, version) pairs
+    to advertise in the registry, by default wl_compositor and
+    wl_shm.  formats are the wl_shm formats announced on binding
+    wl_shm.
+
+    Connect a client with connect(), which returns a Display using
+    the other end of the socket pair.
+    """
+    def __init__(self, protocol, globals=None, formats=(0, 1)):
+        self.protocol = protocol
+        self.formats = formats
+        self._sock, self.client_socket = socket.socketpair()
+        self._sock.setblocking(False)
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_w, False)
+        # Guards all state; handlers run with it held
+        self._lock = threading.RLock()
+        self._thread = None
+        self._running = False
+        self.closed = False
+        self.objects = {}
+        self.objects[1] = MockObject(1, protocol['wl_display'], 1)
+        self.globals = {}
+        self._next_global = 1
+        self._next_server_id = SERVER_ID_START
+        self._registries = []
+        self.handlers = {}
+        self.serial = 0
+        # Requests received, keyed by "interface.request"
+        self.request_counts = collections.Counter()
+        self._in = b''
+        self._in_fds = []
+        # Pending output as (bytes, fds) pairs, and firehoses as
+        # [message, remaining] lists
+        self._out = collections.deque()
+        self._firehoses = collections.deque()
+        if globals is None:
+            globals = [('wl_compositor', 3), ('wl_shm', 1)]
+        for name, version in globals:
+            self.add_global(name, version)
+
+    def connect(self):
+        """Return a Display connected to this server"""
+        return MakeDisplay(self.protocol)(self.client_socket)
+
+    def close(self):
+        """Stop the server thread, if any, and close the server socket"""
+        self.stop()
+        if self._wake_r is None:
+            return
+        self.closed = True
+        self._sock.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        self._wake_r = self._wake_w = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def start(self):
+        """Serve the connection from a new daemon thread"""
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the server thread started by start()"""
+        if self._thread is not None:
+            self._running = False
+            self._wake()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while self._running and not self.closed:
+            self.process(None)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'x')
+        except BlockingIOError:
+            pass
+
+    def on(self, interface, request, handler):
+        """Call handler(obj, *args) for a request instead of the default
+
+        Objects created by the request are passed as MockObjects
+        already entered in the object table.
+        """
+        self.handlers[(interface, request)] = handler
+
+    def process(self, timeout=0):
+        """Wait up to timeout seconds for requests, and service them.
+
+        None means wait until something happens.  Reads and handles
+        every request available, then sends as much pending output as
+        the socket will take.
+        """
+        with self._lock:
+            if self.closed:
+                return
+            pending = bool(self._out or self._firehoses)
+        r, w, x = select.select([self._sock, self._wake_r],
+                                [self._sock] if pending else [], [], timeout)
+        if self._wake_r in r:
+            os.read(self._wake_r, 4096)
+        with self._lock:
+            if self.closed:
+                return
+            if self._sock in r:
+                self._recv()
+                self._handle()
+            self._send()
+
+    def _recv(self):
+        fds = []
+        while True:
+            try:
+                data, ancdata, flags, addr = self._sock.recvmsg(
+                    65536, socket.CMSG_SPACE(28 * 4))
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                # The client closed with requests still unread
+                data, ancdata = b'', []
+            for level, type_, cdata in ancdata:
+                if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+                    fds.extend(struct.unpack(
+                        "{}i".format(len(cdata) // 4),
+                        cdata[:len(cdata) - len(cdata) % 4]))
+            if not data:
+                self.closed = True
+                break
+            self._in += data
+        self._in_fds.extend(fds)
+
+    def _handle(self):
+        data = self._in
+        pos = 0
+        while len(data) - pos >= 8:
+            oid, sizeop = struct.unpack_from("II", data, pos)
+            size = sizeop >> 16
+            if size < 8 or size & 3 or size > MAX_MESSAGE_SIZE:
+                # Nothing after this can be trusted
+                self.post_error(self.objects[1], 1,
+                                "invalid message size {}".format(size))
+                pos = len(data)
+                break
+            if len(data) - pos < size:
+                break
+            self._request(oid, sizeop & 0xffff, data[pos + 8 : pos + size])
+            pos += size
+        self._in = data[pos:]
+
+    def _request(self, oid, opcode, body):
+        obj = self.objects.get(oid)
+        if obj is None:
+            self.post_error(self.objects[1], 0,
+                            "invalid object {}".format(oid))
+            return
+        if opcode >= len(obj.interface.requests_by_number):
+            self.post_error(obj, 1, "invalid opcode {}".format(opcode))
+            return
+        request = obj.interface.requests_by_number[opcode]
+        self.request_counts[str(request)] += 1
+        args = self._unmarshal(obj, request, body)
+        if args is None:
+            return
+        f = self.handlers.get((obj.interface.name, request.name))
+        if f is None:
+            f = getattr(self, "handle_{}_{}".format(
+                obj.interface.name, request.name), None)
+        if f is not None:
+            f(obj, *args)
+        else:
+            # Nobody will close them
+            for a, v in zip(request.args, args):
+                if a.type == "fd":
+                    os.close(v)
+        if request.is_destructor:
+            self.destroy(obj)
+
+    def _unmarshal(self, obj, request, body):
+        argdata = io.BytesIO(body)
+        args = []
+        for arg in request.args:
+            if arg.type == "new_id":
+                if arg.interface:
+                    interface = self.protocol[arg.interface]
+                    version = obj.version
+                else:
+                    (l, ) = struct.unpack("I", argdata.read(4))
+                    name = argdata.read(l)[:-1].decode('utf-8')
+                    argdata.read(-l % 4)
+                    (version, ) = struct.unpack("I", argdata.read(4))
+                    try:
+                        interface = self.protocol[name]
+                    except KeyError:
+                        self.post_error(self.objects[1], 0,
+                                        "unknown interface " + name)
+                        return
+                (nid, ) = struct.unpack("I", argdata.read(4))
+                new = MockObject(nid, interface, version)
+                self.objects[nid] = new
+                args.append(new)
+            elif arg.type == "object":
+                (v, ) = struct.unpack("I", argdata.read(4))
+                args.append(self.objects.get(v))
+            else:
+                args.append(arg.unmarshal(argdata, self._in_fds))
+        return args
+
+    def _encode(self, obj, event, args):
+        args = list(args)
+        parts = []
+        fds = []
+        for arg in event.args:
+            if arg.type in ("new_id", "object"):
+                v = args.pop(0)
+                parts.append(struct.pack("I", v.oid if v else 0))
+            else:
+                b, r, f = arg.marshal(args)
+                parts.append(b)
+                fds.extend(f)
+        body = b''.join(parts)
+        return (struct.pack("II", obj.oid,
+                            ((len(body) + 8) << 16) | event.number) + body,
+                fds)
+
+    def send_event(self, obj, name, *args):
+        """Send the named event on obj
+
+        Object arguments are MockObjects; fd arguments are duplicated,
+        so the caller keeps the original.
+        """
+        with self._lock:
+            self._out.append(self._encode(
+                obj, obj.interface.events_by_name[name], args))
+        if self._thread is not None:
+            self._wake()
+
+    def firehose(self, obj, name, args=(), count=1000):
+        """Send the named event on obj count times, as fast as possible
+
+        The message is encoded once and sent in large chunks, without
+        holding the whole stream in memory.
+        """
+        with self._lock:
+            message, fds = self._encode(
+                obj, obj.interface.events_by_name[name], args)
+            if fds:
+                for fd in fds:
+                    os.close(fd)
+                raise ValueError("can't firehose events with fds")
+            self._firehoses.append([message, count])
+        if self._thread is not None:
+            self._wake()
+
+    def _send(self):
+        out = self._out
+        while True:
+            if not out:
+                if not self._firehoses:
+                    return True
+                hose = self._firehoses[0]
+                n = min(hose[1], max(1, 65536 // len(hose[0])))
+                out.append((hose[0] * n, []))
+                hose[1] -= n
+                if not hose[1]:
+                    self._firehoses.popleft()
+            b, fds = out.popleft()
+            if not fds:
+                # Coalesce small messages into one sendmsg()
+                parts = [b]
+                size = len(b)
+                while out and not out[0][1] and size < 65536:
+                    parts.append(out[0][0])
+                    size += len(out.popleft()[0])
+                b = b''.join(parts)
+            try:
+                if fds:
+                    sent = self._sock.sendmsg(
+                        [b], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                               struct.pack("{}i".format(len(fds)), *fds))])
+                    for fd in fds:
+                        os.close(fd)
+                else:
+                    sent = self._sock.send(b)
+            except BlockingIOError:
+                out.appendleft((b, fds))
+                return False
+            except OSError:
+                # The client has gone away
+                self.closed = True
+                return False
+            if sent < len(b):
+                out.appendleft((b[sent:], []))
+                return False
+
+    def next_serial(self):
+        """Return a new event serial number"""
+        self.serial += 1
+        return self.serial
+
+    def new_object(self, interface, version):
+        """Create a server-side object, for new_id event arguments"""
+        with self._lock:
+            oid = self._next_server_id
+            self._next_server_id += 1
+            obj = MockObject(oid, self.protocol[interface], version)
+            self.objects[oid] = obj
+            return obj
+
+    def destroy(self, obj):
+        """Forget obj, and send delete_id if the client created it"""
+        with self._lock:
+            del self.objects[obj.oid]
+            if obj.oid < SERVER_ID_START:
+                self.send_event(self.objects[1], 'delete_id', obj.oid)
+
+    def post_error(self, obj, code, message):
+        """Send wl_display.error about obj"""
+        self.send_event(self.objects[1], 'error', obj, code, message)
+
+    def add_global(self, interface, version):
+        """Advertise a global, returning its name"""
+        with self._lock:
+            name = self._next_global
+            self._next_global += 1
+            self.globals[name] = (self.protocol[interface], version)
+            for registry in self._registries:
+                self.send_event(registry, 'global', name, interface, version)
+            return name
+
+    def remove_global(self, name):
+        """Withdraw a global"""
+        with self._lock:
+            del self.globals[name]
+            for registry in self._registries:
+                self.send_event(registry, 'global_remove', name)
+
+    def handle_wl_display_sync(self, display, callback):
+        self.send_event(callback, 'done', self.next_serial())
+        self.destroy(callback)
+
+    def handle_wl_display_get_registry(self, display, registry):
+        self._registries.append(registry)
+        for name, (interface, version) in self.globals.items():
+            self.send_event(registry, 'global', name, interface.name, version)
+
+    def handle_wl_registry_bind(self, registry, name, obj):
+        if name not in self.globals or \
+           self.globals[name][0] is not obj.interface:
+            self.post_error(registry, 0, "invalid global {}".format(name))
+            return
+        if obj.interface.name == "wl_shm":
+            for f in self.formats:
+                self.send_event(obj, 'format', f)
+
+    def handle_wl_shm_create_pool(self, shm, pool, fd, size):
+        os.close(fd)
+        pool.state['size'] = size
+
+    def handle_wl_surface_attach(self, surface, buffer, x, y):
+        surface.state['buffer'] = buffer
+
+    def handle_wl_surface_frame(self, surface, callback):
+        surface.state.setdefault('frames', []).append(callback)
+
+    def handle_wl_surface_commit(self, surface):
+        buffer = surface.state.pop('buffer', None)
+        if buffer is not None and buffer.oid in self.objects:
+            self.send_event(buffer, 'release')
+        frames = surface.state.pop('frames', [])
+        now = int(time.monotonic() * 1000) & 0xffffffff
+        for callback in frames:
+            self.send_event(callback, 'done', now)
+            self.destroy(callback)
@@ -2,8 +2,27 @@
 
 import xml.etree.ElementTree as ET
 import struct
+import io
 import os
 import logging
+import time
+import weakref
+import collections.abc
+
+# Whether individual requests and events are logged; see log_messages()
+_log_messages = False
+
+def log_messages(enabled=True):
+    """Switch logging of individual requests and events on or off.
+
+    Logging every message is expensive even when the logger discards
+    the records, so by default requests, events and the bookkeeping
+    around them are not passed to the logging module at all.  Call
+    this to have them logged (at INFO and DEBUG level) again.
+    Warnings and errors are always logged.
+    """
+    global _log_messages
+    _log_messages = enabled
 
 def _description(d):
     assert d.tag == "description"
@@ -17,6 +36,10 @@ class DeletedProxyException(Exception):
     """A request was made on an object that has already been deleted"""
     pass
 
+class MalformedMessageException(Exception):
+    """A message's arguments don't fit in the message"""
+    pass
+
 class DuplicateInterfaceName(Exception):
     """A duplicate interface name was detected.
 
@@ -24,6 +47,110 @@ class DuplicateInterfaceName(Exception):
     """
     pass
 
+class TransferFd:
+    """A file descriptor whose ownership is handed to the library.
+
+    Normally a file descriptor passed as a request argument is
+    duplicated, and the duplicate is closed once it has been sent;
+    the caller keeps the original.  Wrapping the fd in TransferFd
+    instead hands it over: it is sent without being duplicated and
+    is closed by the library exactly once, either after it has been
+    sent or when the request it was passed to is dropped.  The caller
+    must not use or close the fd afterwards.
+
+    fd is an fd number, or an object such as a socket whose detach()
+    method gives up its fd.  Other objects with a fileno(), such as
+    open files, are refused with TypeError: they would close the fd
+    again when they are finalized, by which time the number may
+    belong to something else.  Pass os.dup(f.fileno()) instead.
+    """
+    __slots__ = ('fd',)
+
+    def __init__(self, fd):
+        if not isinstance(fd, int):
+            # The detach() of io objects returns the underlying raw
+            # stream, which still owns the fd
+            if isinstance(fd, io.IOBase) or not hasattr(fd, 'detach'):
+                raise TypeError(
+                    "TransferFd needs an fd number or an object whose "
+                    "detach() gives up its fd, not {}".format(
+                        type(fd).__name__))
+            fd = fd.detach()
+        self.fd = fd
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __repr__(self):
+        return "TransferFd({})".format(self.fd)
+
+def _close_transferred(args):
+    # Requests that are dropped without being marshalled still own
+    # any fds that were transferred to them
+    for a in args:
+        if isinstance(a, TransferFd):
+            a.close()
+
+def weak_handler(f):
+    """Wrap an event handler so that it is only weakly referenced.
+
+    Handlers in a proxy's dispatcher are normally strong references,
+    so a bound method keeps its object alive for as long as the proxy
+    exists.  The returned function calls f while f (or, for a bound
+    method, its object) is still alive, and does nothing afterwards.
+    """
+    if hasattr(f, '__self__'):
+        ref = weakref.WeakMethod(f)
+    else:
+        ref = weakref.ref(f)
+    def handler(*args):
+        f = ref()
+        if f is not None:
+            return f(*args)
+    return handler
+
+class _Dispatcher(collections.abc.MutableMapping):
+    # Dictionary-like view of a proxy's handlers, keyed by event name.
+    # The handlers themselves are stored in a list indexed by event
+    # opcode, which is what dispatch_event() uses.
+    __slots__ = ('_proxy',)
+
+    def __init__(self, proxy):
+        self._proxy = proxy
+
+    def _opcode(self, name):
+        return self._proxy.interface.events_by_name[name].number
+
+    def __getitem__(self, name):
+        f = self._proxy._get_handlers()[self._opcode(name)]
+        if f is None:
+            raise KeyError(name)
+        return f
+
+    def __setitem__(self, name, f):
+        self._proxy._own_handlers()[self._opcode(name)] = f
+
+    def __delitem__(self, name):
+        handlers = self._proxy._own_handlers()
+        opcode = self._opcode(name)
+        if handlers[opcode] is None:
+            raise KeyError(name)
+        handlers[opcode] = None
+
+    def __iter__(self):
+        events = self._proxy.interface.events_by_number
+        for event, f in zip(events, self._proxy._get_handlers()):
+            if f is not None:
+                yield event.name
+
+    def __len__(self):
+        return sum(1 for f in self._proxy._get_handlers() if f is not None)
+
 class ClientProxy:
     """Abstract base class for a proxy to an interface.
 
@@ -44,37 +171,158 @@ class ClientProxy:
 
     version: the version of this object
 
-    dispatcher: dictionary mapping event names to callback functions
+    dispatcher: dictionary-like object mapping event names to callback
+    functions; only names of events of the interface may be used
 
     silence: dictionary of event names that will not be logged
+
+    on_deleted: None, or a function called with the proxy once the
+    object has been deleted and its ID released; for objects created
+    by the client this is when the server sends
+    wl_display.delete_id, and for objects created by the server it is
+    when the client destroys them
+
+    user_data: None, or anything the application wants to associate
+    with the object, like wl_proxy_set_user_data() in libwayland; for
+    example the window a wl_surface belongs to.  Since the attributes
+    live in slots, this is the place for such data: new attributes
+    can't be added to a proxy.
+
+    log (class attribute): the logger for this interface
+
+    Handlers are called with the proxy followed by the event
+    arguments.  They are kept in a list indexed by event opcode.
+    Until a proxy is given handlers of its own it shares the class's
+    list of default handlers, set with set_default_handler() or
+    add_default_listener(); the first handler set on the proxy takes
+    a copy of the defaults as they are at that time.
+
+    Proxies are created for every frame callback and roundtrip, so
+    they are kept small: the attributes live in slots, and the handler
+    list and silence dictionary are only created when they are first
+    needed.
     """
+    __slots__ = ('display', 'oid', 'queue', 'version', 'destroyed',
+                 'on_deleted', 'user_data', '_handlers', '_silence',
+                 '__weakref__')
+
+    log = logging.getLogger(__name__)
+
+    # Replaced by a list with an entry per event in each derived class
+    _default_handlers = []
 
     def __init__(self, display, oid, queue, version):
         self.display = display
         self.oid = oid
         self.queue = queue
         self.version = version
-        self.dispatcher = {}
-        self.silence = {}
         self.destroyed = False
-        self.log = logging.getLogger(__name__ + "." + self.interface.name)
+        self.on_deleted = None
+        self.user_data = None
+        self._handlers = None
+        self._silence = None
+
+    def _get_handlers(self):
+        h = self._handlers
+        return self._default_handlers if h is None else h
+
+    def _own_handlers(self):
+        if self._handlers is None:
+            self._handlers = list(self._default_handlers)
+        return self._handlers
+
+    @property
+    def dispatcher(self):
+        return _Dispatcher(self)
+
+    def add_listener(self, listener, weak=False):
+        """Set handlers from the methods of a listener object.
+
+        For each event of the interface, if listener has a method
+        called "on_" followed by the event name, that method becomes
+        the handler for the event.  It is called with the proxy
+        followed by the event arguments.  If weak is True the
+        listener is only weakly referenced; see weak_handler().
+        """
+        handlers = self._own_handlers()
+        for event in self.interface.events_by_number:
+            f = getattr(listener, 'on_' + event.name, None)
+            if f is not None:
+                handlers[event.number] = weak_handler(f) if weak else f
+
+    @classmethod
+    def set_default_handler(cls, name, f):
+        """Set the default handler for an event on this interface.
+
+        Affects every proxy of the class that has no handlers of its
+        own yet.
+        """
+        cls._default_handlers[cls.interface.events_by_name[name].number] = f
+
+    @classmethod
+    def add_default_listener(cls, listener):
+        """Set default handlers from the methods of a listener object.
+
+        See add_listener() and set_default_handler().
+        """
+        for event in cls.interface.events_by_number:
+            f = getattr(listener, 'on_' + event.name, None)
+            if f is not None:
+                cls._default_handlers[event.number] = f
+
+    @property
+    def silence(self):
+        if self._silence is None:
+            self._silence = {}
+        return self._silence
 
     def _marshal_request(self, request, *args):
         # args is a tuple when called; we make it a list so it's mutable,
         # because args are consumed in the 'for' loop
+        values = args
         args = list(args)
         al = []
         rval = None
         fl = []
-        for a in request.args:
-            b, r, fds = a.marshal_for_request(args, self)
-            al.append(b)
-            fl = fl + fds
-            rval = rval or r
-        assert len(args) == 0
-        al = bytes().join(al)
-        b = struct.pack('II', self.oid, ((len(al) + 8) << 16) | request.opcode)
-        self.display._queue_request(b + al, fl)
+        deleted = False
+        # New object IDs must reach the server in the order they were
+        # allocated, so allocation and queueing happen under one lock
+        with self.display._lock:
+            try:
+                for a in request.args:
+                    b, r, fds = a.marshal_for_request(args, self)
+                    al.append(b)
+                    fl = fl + fds
+                    rval = rval or r
+                assert len(args) == 0
+                al = bytes().join(al)
+                b = struct.pack('II', self.oid,
+                                ((len(al) + 8) << 16) | request.opcode)
+            except BaseException:
+                # Nothing will be sent: close the fds taken so far and
+                # those transferred to arguments not yet reached, and
+                # give back the ID of the new object
+                for fd in fl:
+                    os.close(fd)
+                _close_transferred(args)
+                if rval is not None:
+                    del self.display.objects[rval.oid]
+                    self.display.oid_allocator.free(rval.oid)
+                    rval.oid = None
+                raise
+            # Traced under the lock, so records are in wire order
+            tracer = self.display.tracer
+            if tracer is not None:
+                tracer.request(self, request, al, fl, values)
+            self.display._queue_request(b + al, fl)
+            metrics = self.display.metrics
+            if metrics is not None:
+                metrics.request(request, len(al) + 8)
+            if request.is_destructor:
+                self.destroyed = True
+                deleted = self.display._zombify(self)
+        if deleted and self.on_deleted:
+            self.on_deleted(self)
         return rval
 
     def _unmarshal_event(self, opcode, argdata, fd_source):
@@ -86,27 +334,47 @@ class ClientProxy:
         return (self, event, args)
 
     def set_queue(self, new_queue):
-        # Sets the queue for events received from this object
+        """Set the queue for events received from this object.
+
+        Events already queued stay where they are.  Objects created by
+        requests on this proxy will inherit the new queue.
+        """
         self.queue = new_queue
 
     def dispatch_event(self, event, args):
         if self.destroyed:
-            self.log.info("ignore   event %s(%d).%s%s on destroyed proxy",
-                          self.interface.name,
-                          self.oid, event.name, args)
+            if _log_messages:
+                self.log.info(
+                    "ignore   event %s(%d).%s%s on destroyed proxy",
+                    self.interface.name, self.oid, event.name, args)
+            # Nobody else will close fds that arrived with the event
+            if event.fd_count:
+                for arg, v in zip(event.args, args):
+                    if arg.type == "fd":
+                        os.close(v)
             return
-        f = self.dispatcher.get(event.name, None)
-        if f:
-            if event.name not in self.silence:
-                self.log.info("dispatch event %s(%d).%s%s",
-                              self.interface.name,
-                              self.oid, event.name, args)
-            f(self, *args)
-        else:
-            if event.name not in self.silence:
-                self.log.info("ignore   event %s(%d).%s%s",
+        h = self._handlers
+        if h is None:
+            h = self._default_handlers
+        f = h[event.number]
+        if _log_messages:
+            s = self._silence
+            if not s or event.name not in s:
+                self.log.info("%s event %s(%d).%s%s",
+                              "dispatch" if f else "ignore  ",
                               self.interface.name,
                               self.oid, event.name, args)
+        if f:
+            profiler = self.display.profiler
+            if profiler is None:
+                f(self, *args)
+                return
+            start = time.perf_counter_ns()
+            try:
+                f(self, *args)
+            finally:
+                profiler.record(self, event,
+                                time.perf_counter_ns() - start)
 
     def __str__(self):
         return "{}({})".format(self.interface.name, self.oid)
@@ -122,8 +390,9 @@ class Arg:
 
     Has a name, type, optional description, and optional summary.
 
-    If this argument creates a new object, the interface for the new
-    object is accessible as the "interface" attribute.
+    If this argument refers to an object or creates a new one, the
+    name of the object's interface is accessible as the "interface"
+    attribute; it is None if the protocol doesn't say.
 
     If the argument may be null (None), the "allow_null" attribute is
     True.
@@ -236,7 +505,6 @@ class Arg_new_id(Arg):
             assert self.interface
 
     def marshal_for_request(self, args, proxy):
-        nid = proxy.display._get_new_oid()
         if self.interface:
             # The interface type is part of the argument, and the
             # version of the newly created object is the same as the
@@ -244,7 +512,7 @@ class Arg_new_id(Arg):
             npc = self.parent.interface.protocol[self.interface]\
                                        .client_proxy_class
             version = proxy.version
-            b = struct.pack('I', nid)
+            b = b''
         else:
             # The interface and version are supplied by the caller,
             # and the argument is marshalled as string,uint32,uint32
@@ -255,20 +523,21 @@ class Arg_new_id(Arg):
             parts = (struct.pack('I',len(iname)+1),
                      iname,
                      b'\x00'*(4-(len(iname) % 4)),
-                     struct.pack('II',version,nid))
+                     struct.pack('I',version))
             b = b''.join(parts)
-        new_proxy = npc(proxy.display, nid, proxy.display._default_queue,
-                        version)
+        # Allocated once the caller's arguments have been checked, so
+        # that a bad one doesn't use up an ID
+        nid = proxy.display._get_new_oid()
+        new_proxy = npc(proxy.display, nid, proxy.queue, version)
         proxy.display.objects[nid] = new_proxy
-        return b, new_proxy, []
+        return b + struct.pack('I', nid), new_proxy, []
 
     def unmarshal_from_event(self, argdata, fd_source, proxy):
         assert self.interface
         (nid, ) = struct.unpack("I", argdata.read(4))
         npc = self.parent.interface.protocol[self.interface].client_proxy_class
-        new_proxy = npc(proxy.display, nid, proxy.display._default_queue,
-                        proxy.version)
-        proxy.display.objects[nid] = new_proxy
+        new_proxy = npc(proxy.display, nid, proxy.queue, proxy.version)
+        proxy.display._add_server_object(new_proxy)
         return new_proxy
 
 class Arg_string(Arg):
@@ -284,15 +553,24 @@ class Arg_string(Arg):
     def unmarshal(self, argdata, fd_source):
         # The length includes the terminating null byte
         (l, ) = struct.unpack("I", argdata.read(4))
-        assert l > 0
-        l = l-1
-        s = argdata.read(l).decode('utf-8')
-        argdata.read(4 - (l % 4))
-        return s
+        if l == 0:
+            return None
+        b = argdata.read(l)
+        if len(b) < l:
+            raise MalformedMessageException(
+                "string length {} exceeds message".format(l))
+        if b[-1] != 0:
+            raise MalformedMessageException("string is not terminated")
+        argdata.read(-l % 4)
+        return b[:-1].decode('utf-8')
 
 class Arg_object(Arg):
     """Existing object argument"""
 
+    def __init__(self, parent, arg):
+        super(Arg_object, self).__init__(parent, arg)
+        self.interface = arg.get('interface', None)
+
     def marshal(self, args):
         v = args.pop(0)
         if v:
@@ -306,14 +584,30 @@ class Arg_object(Arg):
 
     def unmarshal_from_event(self, argdata, fd_source, proxy):
         (v, ) = struct.unpack("I", argdata.read(4))
-        return proxy.display.objects.get(v, None)
+        obj = proxy.display.objects.get(v, None)
+        if obj is not None and obj.destroyed:
+            # Objects we have destroyed are as good as null
+            return None
+        return obj
 
 class Arg_fd(Arg):
-    """File descriptor argument"""
+    """File descriptor argument
+
+    The value may be an fd number, which is duplicated so that the
+    caller keeps ownership of the original, or a TransferFd, whose fd
+    is sent as-is and closed by the library once it has been sent.
+    """
 
     def marshal(self, args):
         v = args.pop(0)
-        fd = os.dup(v)
+        if isinstance(v, TransferFd):
+            fd = v.fd
+            if fd is None:
+                raise ValueError("TransferFd has already been consumed")
+            # Ownership now lies with the send queue
+            v.fd = None
+        else:
+            fd = os.dup(v)
         return b'', None, [fd]
 
     def unmarshal(self, argdata, fd_source):
@@ -353,13 +647,16 @@ class Arg_array(Arg):
         v = args.pop(0)
         # v should be bytes
         parts = (struct.pack('I',len(v)),
-                 estr,
+                 v,
                  b'\x00'*(3 - ((len(v) - 1) % 4)))
         return b''.join(parts), None, []
 
     def unmarshal(self, argdata, fd_source):
         (l, ) = struct.unpack("I", argdata.read(4))
         v = argdata.read(l)
+        if len(v) < l:
+            raise MalformedMessageException(
+                "array length {} exceeds message".format(l))
         pad = 3 - ((l - 1) % 4)
         if pad:
             argdata.read(pad)
@@ -416,25 +713,30 @@ class Request:
         if not proxy.oid:
             proxy.log.warning("request %s on deleted %s proxy",
                               self.name, proxy.interface.name)
+            _close_transferred(args)
             raise DeletedProxyException
         if proxy.destroyed:
-            proxy.log.info("request %s.%s%s on destroyed object; ignoring",
-                           proxy, self.name, args)
+            if _log_messages:
+                proxy.log.info(
+                    "request %s.%s%s on destroyed object; ignoring",
+                    proxy, self.name, args)
+            _close_transferred(args)
             return
         if proxy.version < self.since:
             proxy.log.error(
                 "request %s.%s%s only exists from version %s, but proxy is "
                 "version %s", proxy, self.name, args, self.since,
                 proxy.version)
+            _close_transferred(args)
             return
         r = proxy._marshal_request(self, *args)
-        if r:
-            proxy.log.info(
-                "request %s.%s%s -> %s", proxy, self.name, args, r)
-        else:
-            proxy.log.info("request %s.%s%s", proxy, self.name, args)
-        if self.is_destructor:
-            proxy.destroyed = True
+        if _log_messages:
+            if r:
+                proxy.log.info(
+                    "request %s.%s%s -> %s", proxy, self.name, args, r)
+            else:
+                proxy.log.info("request %s.%s%s", proxy, self.name, args)
+        if self.is_destructor and _log_messages:
             proxy.log.info(
                 "%s proxy destroyed by destructor request %s%s",
                 proxy, self.name, args)
@@ -465,6 +767,10 @@ class Event:
             elif c.tag == "arg":
                 self.args.append(_make_arg(self, c))
 
+        # Number of fds carried by the event, so that events that are
+        # not going to be decoded can be skipped without leaking fds
+        self.fd_count = sum(1 for a in self.args if a.type == "fd")
+
     def __str__(self):
         return "{}::{}".format(self.interface, self.name)
 
@@ -559,6 +865,7 @@ class Interface:
         self.description = None
         self.summary = None
         self.requests = {}
+        self.requests_by_number = []
         self.events_by_name = {}
         self.events_by_number = []
         self.enums = {}
@@ -569,6 +876,7 @@ class Interface:
             elif c.tag == "request":
                 e = Request(self, len(self.requests), c)
                 self.requests[e.name] = e
+                self.requests_by_number.append(e)
             elif c.tag == "event":
                 e = Event(self, c, len(self.events_by_number))
                 self.events_by_name[e.name] = e
@@ -583,7 +891,10 @@ class Interface:
             return call_request
         d = {
             '__doc__': self.description,
+            '__slots__': (),
             'interface': self,
+            'log': logging.getLogger(__name__ + "." + self.name),
+            '_default_handlers': [None] * len(self.events_by_number),
         }
         for r in self.requests.values():
             d[r.name] = client_proxy_request(r)
@@ -0,0 +1,212 @@
+"""Wire tracing in the format of libwayland's WAYLAND_DEBUG output"""
+
+import array
+import struct
+import sys
+import time
+import wayland.protocol
+
+class Tracer:
+    """Record requests and events in a ring buffer.
+
+    The most recent capacity messages are kept.  Recording a message
+    stores a timestamp, the object ID, the request or event, and its
+    arguments exactly as they were marshalled, together with the
+    numbers of any fds sent with them, in preallocated storage.
+    Nothing is decoded or formatted until the records are dumped,
+    except the names of objects whose interface the protocol doesn't
+    declare, such as the one in wl_display.error, which are only
+    known at the time.  Records never refer to proxies, so they don't
+    keep them or their handlers alive, and a tracer can be left
+    attached in production.  Dumped records look
+    like libwayland's WAYLAND_DEBUG output:
+
+        [1234567.890]  -> wl_surface@12.commit()
+        [1234567.901] wl_callback@15.done(4711)
+
+    If stream is not None, every message is also formatted and written
+    to it as soon as it is recorded, as libwayland does.  This is what
+    a Display sets up when the WAYLAND_DEBUG environment variable is
+    "1" or "client".
+
+    Attach a tracer to a display by setting its "tracer" attribute.
+    Messages are recorded while the display's lock is held, so they
+    are kept in the order they went over the wire even when several
+    threads share the display; a tracer must therefore not be shared
+    between displays.
+    """
+    def __init__(self, capacity=4096, stream=None):
+        self.capacity = capacity
+        self.stream = stream
+        # Wall clock time in microseconds, as libwayland uses
+        self._times = array.array('q', bytes(8 * capacity))
+        self._oids = array.array('I', bytes(4 * capacity))
+        self._messages = [None] * capacity
+        self._data = [None] * capacity
+        # None, or a tuple of fd numbers
+        self._fds = [None] * capacity
+        # None, or a tuple of names for the untyped object arguments
+        self._names = [None] * capacity
+        # Message -> positions of untyped object arguments in the
+        # values it is invoked with or unmarshalled to
+        self._untyped = {}
+        # Total number of messages recorded
+        self.count = 0
+
+    def _record(self, oid, message, data, fds, names):
+        i = self.count % self.capacity
+        self._times[i] = time.time_ns() // 1000
+        self._oids[i] = oid
+        self._messages[i] = message
+        self._data[i] = data
+        self._fds[i] = fds
+        self._names[i] = names
+        self.count += 1
+        if self.stream is not None:
+            self.stream.write(self._format(i) + "\n")
+
+    def request(self, proxy, request, data, fds, args):
+        """Record a request made on proxy
+
+        data is the marshalled arguments, without the message header,
+        and fds the fds sent with them.  args are the values the
+        request was invoked with.
+        """
+        positions = self._untyped.get(request)
+        if positions is None:
+            positions = self._untyped[request] = _untyped_objects(request)
+        self._record(proxy.oid, request, data, tuple(fds) if fds else None,
+                     _names(positions, args) if positions else None)
+
+    def event(self, proxy, event, data, args):
+        """Record an event received for proxy
+
+        data is the marshalled arguments, without the message header,
+        and args the values they were unmarshalled to.
+        """
+        fds = None
+        if event.fd_count:
+            fds = tuple(v for arg, v in zip(event.args, args)
+                        if arg.type == "fd")
+        positions = self._untyped.get(event)
+        if positions is None:
+            positions = self._untyped[event] = _untyped_objects(event)
+        self._record(proxy.oid, event, data, fds,
+                     _names(positions, args) if positions else None)
+
+    def clear(self):
+        """Forget all records"""
+        for l in (self._messages, self._data, self._fds, self._names):
+            for i in range(self.capacity):
+                l[i] = None
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _format(self, i):
+        when = self._times[i]
+        message = self._messages[i]
+        data = self._data[i]
+        fds = iter(self._fds[i] or ())
+        names = iter(self._names[i] or ())
+        is_request = isinstance(message, wayland.protocol.Request)
+        formatted = []
+        pos = 0
+        for arg in message.args:
+            t = arg.type
+            if t == "fd":
+                formatted.append("fd {}".format(next(fds)))
+                continue
+            if t == "string" or t == "array" or \
+               (t == "new_id" and not arg.interface):
+                (n, ) = struct.unpack_from("I", data, pos)
+                pos += 4
+                value = data[pos : pos + n]
+                pos += (n + 3) & ~3
+                if t == "array":
+                    formatted.append("array[{}]".format(n))
+                    continue
+                s = value[:-1].decode('utf-8', 'replace')
+                if t == "string":
+                    formatted.append("nil" if n == 0 else '"{}"'.format(s))
+                    continue
+                # Interface and version are supplied by the caller,
+                # and sent as a string and uint before the ID
+                version, oid = struct.unpack_from("II", data, pos)
+                pos += 8
+                formatted.append('"{}"'.format(s))
+                formatted.append(str(version))
+                formatted.append("new id {}@{}".format(s, oid))
+                continue
+            (v, ) = struct.unpack_from("i" if t in ("int", "fixed")
+                                       else "I", data, pos)
+            pos += 4
+            if t == "new_id":
+                formatted.append("new id {}@{}".format(arg.interface, v))
+            elif t == "object":
+                if not arg.interface:
+                    formatted.append(next(names))
+                elif v == 0:
+                    formatted.append("nil")
+                else:
+                    formatted.append("{}@{}".format(arg.interface, v))
+            elif t == "fixed":
+                formatted.append("{:f}".format(v / 256))
+            else:
+                formatted.append(str(v))
+        return "[{:7d}.{:03d}] {}{}@{}.{}({})".format(
+            (when // 1000) % 0x100000000, when % 1000,
+            " -> " if is_request else "",
+            message.interface.name, self._oids[i], message.name,
+            ", ".join(formatted))
+
+    def lines(self):
+        """Format the recorded messages, oldest first"""
+        start = max(0, self.count - self.capacity)
+        for n in range(start, self.count):
+            yield self._format(n % self.capacity)
+
+    def dump(self, file=None):
+        """Write the recorded messages to file, sys.stderr by default"""
+        if file is None:
+            file = sys.stderr
+        for line in self.lines():
+            file.write(line + "\n")
+        file.flush()
+
+    def dump_on_crash(self, file=None):
+        """Dump the records if the program dies of an uncaught exception"""
+        previous = sys.excepthook
+        def excepthook(*exc_info):
+            try:
+                self.dump(file)
+            finally:
+                previous(*exc_info)
+        sys.excepthook = excepthook
+
+def _untyped_objects(message):
+    # Positions of object arguments without a declared interface in
+    # the values of message.  A request's new_id takes no value if its
+    # interface is declared, and two (interface and version) if not.
+    is_request = isinstance(message, wayland.protocol.Request)
+    positions = []
+    n = 0
+    for arg in message.args:
+        if arg.type == "new_id" and is_request:
+            if not arg.interface:
+                n += 2
+            continue
+        if arg.type == "object" and not arg.interface:
+            positions.append(n)
+        n += 1
+    return tuple(positions)
+
+def _names(positions, values):
+    return tuple(_object(values[n]) for n in positions)
+
+def _object(v):
+    if v is None:
+        return "nil"
+    oid = v.oid if v.oid is not None else "?"
+    return "{}@{}".format(v.interface.name, oid)